@@ -0,0 +1,121 @@
+import array
+import concurrent.futures
+import itertools
+import math
+
+from epood import Shop
+
+# Columns of the tables returned by client_metrics, in order
+METRICS = ("client_id", "lifetime_spend", "purchases", "purchase_frequency", "basket_size")
+
+class HistoryExport:
+    def __init__(self) -> None:
+        """
+        Initialize a compact columnar export of the clients' purchase histories.
+
+        Purchase days of client number i are the rows offsets[i] to offsets[i + 1]
+        of the dates, spend and items columns.
+        """
+        self.client_ids = array.array("q")
+        self.offsets = array.array("q", [0])
+        self.dates = array.array("q")
+        self.spend = array.array("d")
+        self.items = array.array("q")
+
+    def __len__(self) -> int:
+        """
+        Amount of clients in the export.
+
+        :return: How many clients were exported.
+        """
+        return len(self.client_ids)
+
+    def partition(self, start: int, end: int) -> "HistoryExport":
+        """
+        Cut out the clients from start to end, with offsets starting from zero again.
+
+        :param start: Number of the first client.
+        :param end: Number of the client after the last one.
+        :return: Export of just those clients.
+        """
+        part = HistoryExport()
+        first, last = self.offsets[start], self.offsets[end]
+        part.client_ids = self.client_ids[start:end]
+        part.offsets = array.array("q", (offset - first for offset in self.offsets[start:end + 1]))
+        part.dates = self.dates[first:last]
+        part.spend = self.spend[first:last]
+        part.items = self.items[first:last]
+        return part
+
+def export_history(shop: Shop) -> HistoryExport:
+    """
+    Export the purchase history of every registered client.
+
+    The spend of a day is what the client paid at checkout, so later price
+    changes and pricing rules don't change it.
+
+    :param shop: The shop whose clients are exported.
+    :return: The columnar export.
+    """
+    export = HistoryExport()
+    for client in shop.all_clients():
+        export.client_ids.append(client.id)
+        for date, products in client.history.items():
+            export.dates.append(date.toordinal())
+            export.spend.append(client.spent.get(date, 0.0))
+            export.items.append(sum(products.values()))
+        export.offsets.append(len(export.dates))
+    return export
+
+def compute_metrics(export: HistoryExport) -> dict:
+    """
+    Calculate the metrics of every client in an export.
+
+    :param export: The clients that are analysed.
+    :return: Columnar table as {column name: array, ...} with the columns in METRICS.
+    """
+    # Item sums over a client's rows are differences of running totals, spend is summed
+    # per slice instead because running float totals lose precision on big exports
+    item_totals = array.array("q", itertools.accumulate(export.items, initial=0))
+    dates = export.dates
+
+    lifetime_spend = array.array("d")
+    purchases = array.array("q")
+    frequency = array.array("d")
+    basket_size = array.array("d")
+    for start, end in zip(export.offsets, export.offsets[1:]):
+        amount = end - start
+        purchases.append(amount)
+        lifetime_spend.append(math.fsum(export.spend[start:end]))
+        if amount == 0:
+            frequency.append(0.0)
+            basket_size.append(0.0)
+            continue
+        days = max(dates[start:end]) - min(dates[start:end]) + 1
+        # Purchase days per 30 days of being a customer
+        frequency.append(amount * 30 / days)
+        basket_size.append((item_totals[end] - item_totals[start]) / amount)
+
+    return {"client_id": export.client_ids, "lifetime_spend": lifetime_spend, "purchases": purchases,
+            "purchase_frequency": frequency, "basket_size": basket_size}
+
+def client_metrics(export: HistoryExport, workers: int = None, partitions: int = None) -> dict:
+    """
+    Calculate lifetime spend, purchase frequency and basket size of every client in parallel.
+
+    :param export: The clients that are analysed, from export_history.
+    :param workers: Amount of worker processes, all cores by default.
+    :param partitions: How many parts the clients are split into, four per worker by default.
+    :return: Columnar table as {column name: array, ...} with the columns in METRICS, in export order.
+    """
+    if partitions is None:
+        partitions = (workers or 4) * 4
+    size = max(1, -(-len(export) // partitions))
+    parts = [export.partition(start, min(start + size, len(export))) for start in range(0, len(export), size)]
+
+    table = {column: array.array("q" if column in ("client_id", "purchases") else "d") for column in METRICS}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for result in executor.map(compute_metrics, parts):
+            for column in METRICS:
+                table[column].extend(result[column])
+    return table
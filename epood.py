@@ -1,4 +1,19 @@
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
 import datetime
+import functools
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import types
+import weakref
 
 class Product:
     def __init__(self, name: str, price: float) -> None:
@@ -101,6 +116,8 @@ class Client:
         # Add discount to client if they have a gold membership
         self.discount = membership * 0.1
         self.history = {}
+        # What the client paid on every date as {date: money, ...}
+        self.spent = {}
         self.money = money
 
     def __repr__(self) -> repr:
@@ -117,21 +134,980 @@ class Client:
         
         :return: A string that has readable formatting for viewing client's history.
         """
-        history = dict(reversed(list(self.history.items())))
         output = ""
-        for date in history:
+        # Newest date first, one date at a time so histories that live on disk aren't loaded all at once
+        for date, purchases in reversed(self.history.items()):
             output += f"On {date}, you bought: \n"
-            for product in history[date]:
-                output += f"\t{history[date][product]}x {product}\n"
+            for product in purchases:
+                output += f"\t{purchases[product]}x {product}\n"
         output.rstrip("\n")
         return output
 
+class InventoryDelta:
+    def __init__(self, product: Product, delta: int, level: int) -> None:
+        """
+        Initialize an inventory change event.
+
+        :param product: Product whose stock changed.
+        :param delta: Net change of the stock since the previous batch.
+        :param level: Stock level after the last coalesced change.
+        """
+        self.product = product
+        self.delta = delta
+        self.level = level
+
+    def __repr__(self) -> str:
+        """
+        Representor of the inventory change.
+
+        :return: product name with the signed delta and resulting level.
+        """
+        return f"{self.product}: {self.delta:+} -> {self.level}"
+
+class PurchaseEvent:
+    def __init__(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """
+        Initialize a purchase event.
+
+        :param client_id: Id of the client that made the purchase.
+        :param date: Date of the purchase.
+        :param items: The bought products as {product: amount, ...}.
+        """
+        self.client_id = client_id
+        self.date = date
+        self.items = items
+
+    def __repr__(self) -> str:
+        """
+        Representor of the purchase.
+
+        :return: client id, date and the bought items.
+        """
+        return f"{self.client_id} on {self.date}: {self.items}"
+
+class ChangeFeed:
+    def __init__(self, window: float = 0.05, clock=time.monotonic) -> None:
+        """
+        Initialize the change feed.
+
+        Inventory changes of the same product inside one window are merged into a single
+        InventoryDelta, so a hot product produces one event per batch instead of one per call.
+        A timer delivers the batch when the window runs out, even if nothing else is published.
+
+        :param window: How many seconds events are collected before they are delivered.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.window = window
+        self.clock = clock
+        self.subscribers = []
+        self._pending_inventory = {}
+        self._pending_purchases = []
+        self._window_start = None
+        self._timer = None
+        # The timer flushes from its own thread
+        self._lock = threading.RLock()
+
+    def subscribe(self, callback) -> None:
+        """
+        Start delivering batches to the callback.
+
+        :param callback: Function that is called with a list of InventoryDelta and PurchaseEvent objects.
+        """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback) -> None:
+        """
+        Stop delivering batches to the callback.
+
+        :param callback: Previously subscribed function.
+        """
+        if callback not in self.subscribers:
+            raise Exception("Callback is not subscribed")
+        self.subscribers.remove(callback)
+
+    def publish_inventory(self, product: Product, delta: int, level: int) -> None:
+        """
+        Record a change in the inventory.
+
+        :param product: Product whose stock changed.
+        :param delta: Change of the stock.
+        :param level: Stock level after the change.
+        """
+        # Nobody is listening, don't keep anything around
+        if not self.subscribers:
+            return
+
+        with self._lock:
+            pending = self._pending_inventory.get(product)
+            if pending is None:
+                self._pending_inventory[product] = InventoryDelta(product, delta, level)
+            else:
+                pending.delta += delta
+                pending.level = level
+            self._flush_if_window_passed()
+
+    def publish_purchase(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """
+        Record a completed purchase.
+
+        :param client_id: Id of the client that made the purchase.
+        :param date: Date of the purchase.
+        :param items: The bought products as {product: amount, ...}.
+        """
+        if not self.subscribers:
+            return
+
+        with self._lock:
+            self._pending_purchases.append(PurchaseEvent(client_id, date, dict(items)))
+            self._flush_if_window_passed()
+
+    def _flush_if_window_passed(self) -> None:
+        """Deliver the pending events if the current window has run out."""
+        now = self.clock()
+        if self._window_start is None:
+            self._window_start = now
+        waited = now - self._window_start
+        if waited >= self.window:
+            self.flush()
+        elif self._timer is None:
+            # Only a window that is still open needs a timer, so a zero window never starts a thread
+            self._timer = threading.Timer(self.window - waited, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> None:
+        """
+        Deliver all pending events to the subscribers right away.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            # Changes that cancelled each other out (add to cart, then remove) are not worth sending
+            batch = [event for event in self._pending_inventory.values() if event.delta != 0]
+            batch += self._pending_purchases
+
+            self._pending_inventory = {}
+            self._pending_purchases = []
+            self._window_start = None
+
+            if not batch:
+                return
+            for callback in list(self.subscribers):
+                # A failing subscriber doesn't keep the batch from the others
+                try:
+                    callback(batch)
+                except Exception as error:
+                    print(f"Subscriber failed: {error}")
+
+class StockIndex:
+    def __init__(self, threshold: int = None, on_cross=None) -> None:
+        """
+        Initialize the stock index.
+
+        Products are kept sorted by their stock level, so low-stock and best-stocked
+        queries don't have to look at the whole inventory.
+
+        :param threshold: Restock threshold that the on_cross callback watches.
+        :param on_cross: Function that is called as on_cross(product, level, below) when a product's
+                         stock drops below the threshold (below=True) or rises back to it (below=False).
+        """
+        self.threshold = threshold
+        self.on_cross = on_cross
+        # Sorted list of (level, sequence number), the sequence number breaks ties between products
+        self._keys = []
+        self._products = {}
+        self._entries = {}
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        """
+        Amount of products in the index.
+
+        :return: How many products are indexed.
+        """
+        return len(self._keys)
+
+    def update(self, product: Product, delta: int, level: int) -> None:
+        """
+        Move the product to its new stock level. Has the signature of a Shop inventory observer.
+
+        :param product: Product whose stock changed.
+        :param delta: Change of the stock.
+        :param level: Stock level after the change.
+        """
+        entry = self._entries.get(product)
+        if entry is None:
+            entry = (level, next(self._sequence))
+            self._products[entry[1]] = product
+            old_level = None
+        else:
+            old_level = entry[0]
+            del self._keys[bisect.bisect_left(self._keys, entry)]
+            entry = (level, entry[1])
+
+        self._entries[product] = entry
+        bisect.insort(self._keys, entry)
+
+        if self.on_cross is None or self.threshold is None:
+            return
+        now_below = level < self.threshold
+        # A new product that arrives with enough stock hasn't crossed anything
+        was_below = old_level < self.threshold if old_level is not None else False
+        if now_below != was_below:
+            self.on_cross(product, level, now_below)
+
+    def level(self, product: Product) -> int:
+        """
+        Stock level of a product as seen by the index.
+
+        :param product: Product to look up.
+        :return: Stock level of the product.
+        """
+        if product not in self._entries:
+            raise Exception("Product not in index")
+        return self._entries[product][0]
+
+    def below(self, threshold: int) -> list:
+        """
+        Find the products whose stock is below the threshold.
+
+        :param threshold: Stock level that the products have to be under.
+        :return: List of (product, level) tuples, lowest stock first.
+        """
+        end = bisect.bisect_left(self._keys, (threshold,))
+        return [(self._products[sequence], level) for level, sequence in self._keys[:end]]
+
+    def top(self, n: int) -> list:
+        """
+        Find the best-stocked products.
+
+        :param n: How many products to return.
+        :return: List of (product, level) tuples, highest stock first.
+        """
+        if n <= 0:
+            return []
+        return [(self._products[sequence], level) for level, sequence in reversed(self._keys[-n:])]
+
+class Tracer:
+    def __init__(self, capacity: int = 100000, sample_rate: float = 1.0, clock=time.perf_counter_ns) -> None:
+        """
+        Initialize a tracer that records spans of Shop operations.
+
+        Spans are kept in a ring buffer, when it is full the oldest spans are dropped.
+        Sampling is decided per outermost span, a sampled operation keeps all its inner spans.
+
+        :param capacity: How many spans the ring buffer holds.
+        :param sample_rate: Part of the operations that are recorded, 0.1 means every tenth on average.
+        :param clock: Function returning the current time in nanoseconds.
+        """
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.spans = collections.deque(maxlen=capacity)
+        self._random = random.Random()
+        # Open spans as [(name, start), ...], the outermost first
+        self._open = []
+        self._sampled = False
+
+    def begin(self, name: str) -> None:
+        """
+        Open a span.
+
+        :param name: Name of the operation or step.
+        """
+        if not self._open:
+            self._sampled = self.sample_rate >= 1 or self._random.random() < self.sample_rate
+        self._open.append((name, self.clock() if self._sampled else 0))
+
+    def end(self, depth: int = None) -> None:
+        """
+        Close the innermost open span.
+
+        :param depth: Optional amount of spans that stay open, spans an error left open above it are closed too.
+        """
+        if depth is None:
+            depth = len(self._open) - 1
+        while len(self._open) > depth:
+            name, start = self._open.pop()
+            if self._sampled:
+                self.spans.append((name, start, self.clock() - start, len(self._open)))
+
+    def export(self, path: str = None) -> dict:
+        """
+        Export the recorded spans in the Chrome trace event format.
+
+        :param path: Optional file where the trace is written as JSON.
+        :return: The trace as a dictionary.
+        """
+        process = os.getpid()
+        thread = threading.get_ident()
+        events = [{"name": name, "cat": "shop", "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                   "pid": process, "tid": thread, "args": {"depth": depth}}
+                  for name, start, duration, depth in self.spans]
+        trace = {"traceEvents": events, "displayTimeUnit": "ms"}
+        if path is not None:
+            with open(path, "w") as file:
+                json.dump(trace, file)
+        return trace
+
+# Objects that belong to the program and not to the data, the size walk doesn't go into them
+_NOT_DATA = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+             weakref.ReferenceType, threading.Thread)
+
+def deep_size(obj, seen: set = None) -> int:
+    """
+    Size of an object and everything it refers to, in bytes.
+
+    Objects whose id is in seen are not counted again, so a walk over several objects with
+    the same seen set counts shared objects once, for the first object that refers to them.
+
+    :param obj: The object that is measured.
+    :param seen: Ids of objects that are already counted, the new ones are added to it.
+    :return: Amount of bytes.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _NOT_DATA):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        elif not isinstance(obj, (str, bytes, int, float)):
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, "__slots__", ()):
+                    if hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return size
+
+class MemoryReport:
+    def __init__(self, sections: dict, snapshot=None, allocations: list = None) -> None:
+        """
+        Initialize a report of the memory used by the parts of an e-shop.
+
+        :param sections: Bytes and entries of every part as {name: (bytes, entries), ...}.
+        :param snapshot: tracemalloc snapshot taken with the report, if tracemalloc was tracing.
+        :param allocations: tracemalloc statistic differences since an earlier report, biggest first.
+        """
+        self.sections = sections
+        self.snapshot = snapshot
+        self.allocations = allocations
+
+    @property
+    def total(self) -> int:
+        """
+        Bytes used by all the parts together.
+
+        :return: Amount of bytes.
+        """
+        return sum(size for size, entries in self.sections.values())
+
+    def average(self, name: str) -> float:
+        """
+        Bytes per entry of a part.
+
+        :param name: Name of the part.
+        :return: Average amount of bytes, 0 when the part has no entries.
+        """
+        size, entries = self.sections[name]
+        return size / entries if entries else 0.0
+
+    def __repr__(self) -> str:
+        """
+        Representor of the report.
+
+        :return: a table of the parts with their bytes, entries and bytes per entry.
+        """
+        lines = [f"{'part':<16}{'bytes':>12}{'entries':>10}{'per entry':>12}"]
+        for name, (size, entries) in self.sections.items():
+            lines.append(f"{name:<16}{size:>12}{entries:>10}{self.average(name):>12.1f}")
+        lines.append(f"{'total':<16}{self.total:>12}")
+        return "\n".join(lines)
+
+# Markers used by CowMap for keys that aren't there and keys that were deleted
+_MISSING = object()
+_DELETED = object()
+
+class CowMap(collections.abc.MutableMapping):
+    # Layers are flattened into one when there are more than this many
+    MAX_LAYERS = 8
+
+    def __init__(self, data: dict = None, layers: tuple = (), length: int = None) -> None:
+        """
+        Initialize a copy-on-write mapping.
+
+        The contents are a private dictionary on top of frozen layers that can be shared
+        with other maps. fork() freezes the private dictionary and gives both maps the same
+        layers, so forking costs nothing and writes only ever go into the private dictionary.
+        Dictionaries read out of a shared layer with [] are wrapped in a CowMap of their own,
+        so changing them in place doesn't change them for the other maps.
+
+        :param data: Optional starting contents.
+        :param layers: Frozen dictionaries underneath, the newest first.
+        :param length: Amount of keys in the layers, counted when not given.
+        """
+        self._layers = layers
+        self._local = dict(data) if data else {}
+        if length is None:
+            length = sum(1 for key in self._keys())
+        self._length = length
+
+    def _lookup(self, key):
+        """Find the value of a key, _MISSING or _DELETED if it isn't there."""
+        value = self._local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        for layer in self._layers:
+            value = layer.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def _keys(self):
+        """Iterate over the keys in the order they were first added."""
+        seen = set()
+        # Layers are newest first, the oldest layer has the keys that were added first
+        for layer in reversed((self._local,) + self._layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    if self._lookup(key) is not _DELETED:
+                        yield key
+
+    def __contains__(self, key) -> bool:
+        """
+        Check if the key is in the map.
+
+        :param key: The key that is looked up.
+        :return: True if the key has a value.
+        """
+        value = self._lookup(key)
+        return value is not _MISSING and value is not _DELETED
+
+    def __getitem__(self, key):
+        """
+        Get the value of a key, a shared dictionary value is first wrapped so it can be changed.
+
+        :param key: The key that is looked up.
+        :return: The value.
+        """
+        value = self._local.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._lookup(key)
+            if value is _MISSING or value is _DELETED:
+                raise KeyError(key)
+            if isinstance(value, (dict, CowMap)):
+                value = CowMap.over(value)
+                self._local[key] = value
+            return value
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def peek(self, key):
+        """
+        Get the value of a key without wrapping it. Don't change the result.
+
+        :param key: The key that is looked up.
+        :return: The value.
+        """
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        """
+        Set the value of a key.
+
+        :param key: The key that is set.
+        :param value: The new value.
+        """
+        if key not in self:
+            self._length += 1
+        self._local[key] = value
+
+    def __delitem__(self, key) -> None:
+        """
+        Remove a key.
+
+        :param key: The key that is removed.
+        """
+        if key not in self:
+            raise KeyError(key)
+        self._length -= 1
+        if any(key in layer for layer in self._layers):
+            self._local[key] = _DELETED
+        else:
+            del self._local[key]
+
+    def __iter__(self):
+        """
+        Iterate over the keys in the order they were first added.
+
+        :return: Iterator of keys.
+        """
+        return self._keys()
+
+    def __reversed__(self):
+        """
+        Iterate over the keys backwards.
+
+        :return: Iterator of keys.
+        """
+        return reversed(list(self._keys()))
+
+    def __len__(self) -> int:
+        """
+        Amount of keys in the map.
+
+        :return: How many keys have a value.
+        """
+        return self._length
+
+    def __repr__(self) -> str:
+        """
+        Representor of the map.
+
+        :return: the contents as a dictionary.
+        """
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        """
+        Pickle the map as its flattened contents, the shared layers aren't sent along.
+
+        :return: How to rebuild the map.
+        """
+        return CowMap, (dict(self.items()),)
+
+    def items(self):
+        """
+        View of (key, value) pairs that doesn't wrap shared values and can be iterated backwards.
+
+        :return: Items view of the map.
+        """
+        return _CowItems(self)
+
+    def fork(self) -> "CowMap":
+        """
+        Make a copy of the map that shares all the current contents.
+
+        :return: The new map.
+        """
+        if self._local:
+            self._layers = (self._local,) + self._layers
+            self._local = {}
+        if len(self._layers) > self.MAX_LAYERS:
+            merged = {}
+            for layer in reversed(self._layers):
+                merged.update(layer)
+            self._layers = ({key: value for key, value in merged.items() if value is not _DELETED},)
+        return CowMap(layers=self._layers, length=self._length)
+
+    @staticmethod
+    def over(value) -> "CowMap":
+        """
+        Wrap a dictionary or map that is shared in a copy-on-write map of its own.
+
+        :param value: Dictionary or CowMap that must not be changed.
+        :return: Map with the same contents whose changes go to a new private dictionary.
+        """
+        if isinstance(value, CowMap):
+            # The shared map isn't written any more, so its private dictionary is as good as frozen
+            layers = (value._local,) + value._layers if value._local else value._layers
+            return CowMap(layers=layers, length=value._length)
+        return CowMap(layers=(value,), length=len(value))
+
+class _CowItems(collections.abc.ItemsView):
+    def __iter__(self):
+        """Iterate over (key, value) pairs without wrapping shared values."""
+        for key in self._mapping:
+            yield key, self._mapping.peek(key)
+
+    def __reversed__(self):
+        """Iterate over (key, value) pairs backwards without wrapping shared values."""
+        for key in reversed(self._mapping):
+            yield key, self._mapping.peek(key)
+
+def _copy_client(client: Client) -> Client:
+    """
+    Copy a client so the copy can be changed on its own. Products are shared.
+
+    :param client: The client that is copied.
+    :return: The copy.
+    """
+    copy = Client(client.id, client.membership, client.money)
+    copy.discount = client.discount
+    copy.shopping_cart.items = dict(client.shopping_cart.items)
+    copy.history = _copy_history(client.history)
+    copy.spent = dict(client.spent)
+    return copy
+
+def _copy_history(history) -> dict:
+    """
+    Copy a client's history down to the product amounts.
+
+    :param history: History as {date: {product: amount, ...}, ...}.
+    :return: The copy.
+    """
+    return {date: dict(products) for date, products in history.items()}
+
 class Shop:
     def __init__(self) -> None:
         """Create an e-shop class that will handle purchases and history."""
+        # Stock that can still be added to carts
         self.inventory = {}
+        # Stock that sits in shopping carts, on hand stock is inventory and reserved together
+        self.reserved = {}
         self.clients = []
         self.history = {}
+        # {client id: client} for looking up registered clients without going through the list
+        self._clients_by_id = {}
+        self._init_forks()
+        self._init_extensions()
+
+    def _init_forks(self) -> None:
+        """Set up the bookkeeping of the forks made of this e-shop."""
+        self._parent = None
+        self._forks = weakref.WeakSet()
+        self._forked = False
+        # Ids of clients that forks already got their own copy of since the last fork
+        self._detached = set()
+
+    def _init_extensions(self) -> None:
+        """Set up the change feed, observers and the optional parts that are off by default."""
+        self.feed = ChangeFeed()
+        # Functions that are called as observer(product, delta, level) whenever the inventory changes
+        self._inventory_observers = [self.feed.publish_inventory]
+        # Functions that are called as observer(client_id, date, items) whenever a purchase is made
+        self._purchase_observers = [self.feed.publish_purchase]
+        self.stock_index = None
+        # Optional pricing engine, without one the membership discount is the only pricing rule
+        self.pricing = None
+        # Optional function that gives newly registered clients their history mapping
+        self.client_history_factory = None
+        # Optional function that is called with the history of a deleted client, to free what it holds
+        self.client_history_disposer = None
+        # Optional store that idle clients are evicted to, see history_store.page_clients
+        self.sessions = None
+        self._tracer = None
+
+    # Methods that get a span of their own when tracing is on
+    TRACED_METHODS = ("add_to_cart", "add_many_to_cart", "remove_from_cart", "buy", "buy_many", "_complete_purchase",
+                      "register_client", "delete_client", "release_cart", "add_product")
+
+    def enable_tracing(self, tracer: Tracer = None) -> Tracer:
+        """
+        Start recording spans of the e-shop's operations.
+
+        The traced methods are wrapped on this object only, so a shop without tracing runs the plain methods.
+
+        :param tracer: The tracer that records the spans, a new one by default.
+        :return: The tracer.
+        """
+        if tracer is None:
+            tracer = Tracer()
+        self.disable_tracing()
+        self._tracer = tracer
+        for name in self.TRACED_METHODS:
+            setattr(self, name, self._traced(tracer, name, getattr(self, name)))
+        return tracer
+
+    def disable_tracing(self) -> None:
+        """
+        Stop recording spans.
+        """
+        if self._tracer is None:
+            return
+        self._tracer = None
+        for name in self.TRACED_METHODS:
+            delattr(self, name)
+
+    @staticmethod
+    def _traced(tracer: Tracer, name: str, method):
+        """
+        Wrap a method in a span.
+
+        :param tracer: The tracer that records the span.
+        :param name: Name of the span.
+        :param method: The bound method that is wrapped.
+        :return: The wrapped method.
+        """
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            depth = len(tracer._open)
+            tracer.begin(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                tracer.end(depth)
+        return traced
+
+    def _page_in(self, client_id: int) -> None:
+        """
+        Mark a client as recently used, bringing the client back first if it was evicted.
+
+        :param client_id: Id of the client.
+        """
+        if self.sessions is not None:
+            self.sessions.touch(client_id)
+
+    def _is_registered(self, client: Client) -> bool:
+        """
+        Check if the client is registered in the e-shop.
+
+        :param client: The client that is checked.
+        :return: True if the client is registered.
+        """
+        return self._clients_by_id.get(client.id) is client
+
+    def fork(self) -> "ShopFork":
+        """
+        Make a copy of the e-shop for trying things out, the copy and the e-shop don't see each other's changes.
+
+        Forking takes the same time no matter how big the e-shop is. Inventory, clients and history are shared
+        until one side changes them, then only the changed parts are copied. The fork starts without subscribers,
+        indexes or tracing; the pricing engine is shared.
+
+        :return: The fork.
+        """
+        if not isinstance(self.history, (dict, CowMap)) or self.client_history_factory is not None:
+            raise Exception("Only an e-shop with its history in memory can be forked")
+        if self.sessions is not None:
+            raise Exception("An e-shop that evicts clients can't be forked")
+
+        for name in ("inventory", "reserved", "history", "_clients_by_id"):
+            if not isinstance(getattr(self, name), CowMap):
+                # From now on the plain dictionary is a frozen layer, this e-shop writes on top of it
+                setattr(self, name, CowMap.over(getattr(self, name)))
+
+        fork = ShopFork(self)
+        self._forks.add(fork)
+        # The new fork can share clients of every e-shop up the line, they all have to tell it about changes again
+        shop = self
+        while shop is not None:
+            shop._forked = True
+            shop._detached = set()
+            shop = shop._parent
+        return fork
+
+    def _before_client_write(self, client: Client) -> None:
+        """
+        Give the forks their own copy of a client before the client is changed in place.
+
+        :param client: The client that is about to change.
+        """
+        if not self._forked or client.id in self._detached:
+            return
+        self._detached.add(client.id)
+        for fork in list(self._forks):
+            fork._adopt(client)
+        # History of the client can sit in the history shared with the forks, stop changing it in place
+        client.history = _copy_history(client.history)
+
+    def subscribe(self, callback, window: float = None) -> None:
+        """
+        Subscribe to batches of inventory changes and purchases.
+
+        When the window runs out without further changes, the batch is delivered from a timer
+        thread, possibly while the e-shop is being changed in another thread. A window of 0
+        delivers every change right away in the thread that made it.
+
+        :param callback: Function that is called with a list of InventoryDelta and PurchaseEvent objects.
+        :param window: Optionally change how many seconds events are coalesced before delivery.
+        """
+        if window is not None:
+            self.feed.window = window
+        self.feed.subscribe(callback)
+
+    def memory_report(self, since: MemoryReport = None, top: int = 10) -> MemoryReport:
+        """
+        Measure how much memory the parts of the e-shop use.
+
+        Parts are measured in the order products, inventory, history, client_history, carts,
+        clients, and an object that is shared between parts is counted only for the first of
+        them. Purchases that clients' histories share with the e-shop's history count as history.
+
+        While tracemalloc is tracing, the report also keeps a snapshot, and with an earlier
+        report as since the biggest allocation changes between the two are listed.
+
+        :param since: Earlier report to compare the allocations with.
+        :param top: How many allocation changes to list.
+        :return: The report.
+        """
+        # Taken first, so the walk's own bookkeeping isn't in the snapshot
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        allocations = None
+        if since is not None:
+            if snapshot is None or since.snapshot is None:
+                raise Exception("tracemalloc has to be tracing for both reports to compare allocations")
+            allocations = snapshot.compare_to(since.snapshot, "lineno")[:top]
+
+        clients = list(self.clients)
+        products = {id(product): product for product in itertools.chain(self.inventory, self.reserved)}
+        seen = set()
+        sections = {}
+
+        def measure(name, objects, entries):
+            sections[name] = (sum(deep_size(obj, seen) for obj in objects), entries)
+
+        measure("products", products.values(), len(products))
+        measure("inventory", [self.inventory, self.reserved], len(self.inventory))
+        measure("history", [self.history], sum(len(purchases) for date, purchases in self.history.items()))
+        measure("client_history", [client.history for client in clients], sum(len(client.history) for client in clients))
+        measure("carts", [client.shopping_cart for client in clients], len(clients))
+        measure("clients", [self.clients, self._clients_by_id], len(clients))
+
+        return MemoryReport(sections, snapshot, allocations)
+
+    def add_observer(self, inventory=None, purchase=None) -> None:
+        """
+        Start calling functions on every change, in the thread that makes the change.
+
+        :param inventory: Optional function that is called as inventory(product, delta, level) when the inventory changes.
+        :param purchase: Optional function that is called as purchase(client_id, date, items) when a purchase is made.
+        """
+        if inventory is not None:
+            self._inventory_observers.append(inventory)
+        if purchase is not None:
+            self._purchase_observers.append(purchase)
+
+    def remove_observer(self, inventory=None, purchase=None) -> None:
+        """
+        Stop calling functions that were added with add_observer.
+
+        :param inventory: Optional inventory observer that is removed.
+        :param purchase: Optional purchase observer that is removed.
+        """
+        if inventory is not None:
+            if inventory not in self._inventory_observers:
+                raise Exception("Observer is not added")
+            self._inventory_observers.remove(inventory)
+        if purchase is not None:
+            if purchase not in self._purchase_observers:
+                raise Exception("Observer is not added")
+            self._purchase_observers.remove(purchase)
+
+    def track_stock(self, threshold: int = None, on_cross=None) -> StockIndex:
+        """
+        Start keeping an index of the products ordered by stock level.
+
+        :param threshold: Restock threshold that the on_cross callback watches.
+        :param on_cross: Function that is called as on_cross(product, level, below) when a product crosses the threshold.
+        :return: The stock index, that stays up to date with the inventory.
+        """
+        if self.stock_index is not None:
+            self.remove_observer(inventory=self.stock_index.update)
+
+        self.stock_index = StockIndex(threshold)
+        for product in self.inventory:
+            self.stock_index.update(product, 0, self.inventory[product])
+        # Products that are already low when tracking starts haven't crossed anything
+        self.stock_index.on_cross = on_cross
+        self.add_observer(inventory=self.stock_index.update)
+        return self.stock_index
+
+    def available(self, product: Product) -> int:
+        """
+        Stock of a product that can still be added to carts.
+
+        :param product: The product that is looked up.
+        :return: Amount of available items.
+        """
+        return self.inventory.get(product, 0)
+
+    def reserved_stock(self, product: Product) -> int:
+        """
+        Stock of a product that sits in shopping carts.
+
+        :param product: The product that is looked up.
+        :return: Amount of reserved items.
+        """
+        return self.reserved.get(product, 0)
+
+    def on_hand(self, product: Product) -> int:
+        """
+        Stock of a product that is physically in the e-shop, in carts or not.
+
+        :param product: The product that is looked up.
+        :return: Amount of items on hand.
+        """
+        return self.inventory.get(product, 0) + self.reserved.get(product, 0)
+
+    def _reserve(self, product: Product, amount: int) -> None:
+        """
+        Move stock from available to reserved, a negative amount moves it back.
+
+        :param product: The product whose stock is moved.
+        :param amount: How many items are moved.
+        """
+        self.reserved[product] = self.reserved.get(product, 0) + amount
+        self._change_inventory(product, -amount)
+
+    def release_cart(self, client: Client) -> None:
+        """
+        Put everything in the client's shopping cart back to the available stock and empty the cart.
+
+        Used when a client is deleted or a cart expires.
+
+        :param client: The client whose cart is released.
+        """
+        self._page_in(client.id)
+        self._before_client_write(client)
+        items = client.shopping_cart.items
+        client.shopping_cart.empty()
+        for product, amount in items.items():
+            self.reserved[product] = self.reserved.get(product, 0) - amount
+        self._change_inventory_many(items)
+
+    @staticmethod
+    def _notify(observers: list, *args) -> None:
+        """
+        Call the observers of a change that is already made, a failing observer can't undo it.
+
+        :param observers: Functions that are called.
+        :param args: Arguments of the calls.
+        """
+        for observer in observers:
+            try:
+                observer(*args)
+            except Exception as error:
+                print(f"Observer failed: {error}")
+
+    def _change_inventory_many(self, deltas: dict) -> None:
+        """
+        Change the stock of several products and notify the observers.
+
+        :param deltas: How much the stock of every product changes as {product: delta, ...}.
+        """
+        inventory = self.inventory
+        for product, delta in deltas.items():
+            inventory[product] = inventory.get(product, 0) + delta
+        for product, delta in deltas.items():
+            self._notify(self._inventory_observers, product, delta, inventory[product])
+
+    def _change_inventory(self, product: Product, delta: int) -> None:
+        """
+        Change the stock of a product and notify the observers.
+
+        :param product: Product whose stock is changed.
+        :param delta: How much the stock changes, negative when stock is taken out.
+        """
+        level = self.inventory.get(product, 0) + delta
+        self.inventory[product] = level
+        self._notify(self._inventory_observers, product, delta, level)
     
     def add_to_cart(self, client: Client, product: Product, amount) -> None:
         """
@@ -141,8 +1117,9 @@ class Shop:
         :param product: the product object that will be added to cart.
         :param amount: the amount of product that is added to the client's cart
         """
+        self._page_in(client.id)
 
-        if client not in self.clients:
+        if not self._is_registered(client):
             print("Client has not registered")
             return
 
@@ -153,10 +1130,34 @@ class Shop:
             raise Exception("Not enough items to add to cart")
         
         if product in self.inventory and self.inventory[product] >= amount:
+            self._before_client_write(client)
             client.shopping_cart.add(product, amount)
 
             # Reserve the item in the cusomer's shopping cart
-            self.inventory[product] -= amount
+            self._reserve(product, amount)
+
+    def add_many_to_cart(self, client: Client, items: dict) -> None:
+        """
+        Add several products to client's cart at once. Nothing is added if any of them can't be.
+
+        :param client: the client object to whose cart the items will be added.
+        :param items: the products and amounts as {product: amount, ...}.
+        """
+        self._page_in(client.id)
+        if not self._is_registered(client):
+            print("Client has not registered")
+            return
+
+        for product, amount in items.items():
+            if product not in self.inventory:
+                raise Exception("Product not in inventory")
+            if self.inventory[product] < amount:
+                raise Exception("Not enough items to add to cart")
+
+        self._before_client_write(client)
+        for product, amount in items.items():
+            client.shopping_cart.add(product, amount)
+            self._reserve(product, amount)
 
     def remove_from_cart(self, client: Client, product: Product, amount: int) -> None:
         """
@@ -166,13 +1167,15 @@ class Shop:
         :param product: the product object that will be removed from cart.
         :param amount: the amount of products that are removed from the client's cart.
         """
+        self._page_in(client.id)
 
-        if client not in self.clients:
+        if not self._is_registered(client):
             print("Client has not registered")
             return
 
+        self._before_client_write(client)
         client.shopping_cart.remove(product, amount)
-        self.inventory[product] += amount
+        self._reserve(product, -amount)
 
     def buy(self, client: Client, date: datetime.date) -> None:
         """
@@ -181,44 +1184,131 @@ class Shop:
         :param client: The client that is performing the purchase.
         :param date: date when the purcahse was made.
         """
-        if client not in self.clients:
+        self._page_in(client.id)
+        tracer = self._tracer
+        if tracer is not None:
+            tracer.begin("registration check")
+        registered = self._is_registered(client)
+        if tracer is not None:
+            tracer.end()
+        if not registered:
             print("Client has not registered")
             return
 
+        if tracer is not None:
+            tracer.begin("funds check")
+        try:
+            if self.pricing is None:
+                value = client.shopping_cart.value
+                price = value - value * client.discount
+            else:
+                price = self.pricing.price(client.shopping_cart, date, client.discount)
+        finally:
+            if tracer is not None:
+                tracer.end()
+
         # If client deosn't have enough money
-        if client.shopping_cart.value - client.shopping_cart.value * client.discount > client.money:
+        if price > client.money:
             print("Client has insufficient funds")
             return
 
-        # Add the current shopping cart to client's history as {date: {product: amount, ...}, ...}
-        if date in client.history:
-            for product in client.shopping_cart.items:
-                if product in client.history[date]:
-                    client.history[date][product] += client.shopping_cart.items[product]
-                else:
-                    client.history[date][product] = client.shopping_cart.items[product]
-        # First time that day buying
-        else:
-            client.history[date] = client.shopping_cart.items
+        self._complete_purchase(client, date, price)
 
-        client.money = client.money - client.shopping_cart.value * (1 - client.discount)
+    def buy_many(self, purchases: list) -> list:
+        """
+        Buy the shopping carts of many clients at once.
 
-        
-        if date in self.history:
-            if client.id in self.history[date]:
+        Carts are priced together per date, so a pricing engine compiles its tables once for the whole batch.
+
+        :param purchases: List of (client, date) tuples.
+        :return: List of booleans in the same order, True if the purchase went through.
+        """
+        results = [False] * len(purchases)
+        by_date = {}
+        for position, (client, date) in enumerate(purchases):
+            self._page_in(client.id)
+            if self._is_registered(client):
+                by_date.setdefault(date, []).append(position)
+
+        for date, positions in by_date.items():
+            clients = [purchases[position][0] for position in positions]
+            if self.pricing is None:
+                prices = [client.shopping_cart.value - client.shopping_cart.value * client.discount for client in clients]
+            else:
+                prices = self.pricing.price_batch([client.shopping_cart for client in clients], date,
+                                                  [client.discount for client in clients])
+
+            for position, client, price in zip(positions, clients, prices):
+                # The same client can appear twice in a batch, the second time the cart is already empty
+                if client.shopping_cart.items and price <= client.money:
+                    # Later clients of a big batch can have evicted this one again
+                    self._page_in(client.id)
+                    self._complete_purchase(client, date, price)
+                    results[position] = True
+                elif not client.shopping_cart.items:
+                    results[position] = True
+        return results
+
+    def _complete_purchase(self, client: Client, date: datetime.date, price: float) -> None:
+        """
+        Move the shopping cart to the histories and charge the client.
+
+        :param client: The client that is performing the purchase.
+        :param date: date when the purcahse was made.
+        :param price: What the client pays for the shopping cart.
+        """
+        self._before_client_write(client)
+
+        tracer = self._tracer
+        if tracer is not None:
+            tracer.begin("history merge")
+
+        try:
+            # Add the current shopping cart to client's history as {date: {product: amount, ...}, ...}
+            if date in client.history:
                 for product in client.shopping_cart.items:
-                    if product in self.history[date][client.id]:
-                        self.history[date][client.id][product] += client.shopping_cart.items[product]  
+                    if product in client.history[date]:
+                        client.history[date][product] += client.shopping_cart.items[product]
                     else:
-                        self.history[date][client.id][product] = client.shopping_cart.items[product]
+                        client.history[date][product] = client.shopping_cart.items[product]
+            # First time that day buying
             else:
-                # First time to buy for the client to buy on that day
-                self.history[date][client.id] = client.shopping_cart.items
-        # First purchase of the day
-        else:
-            self.history[date] = {client.id: client.shopping_cart.items.copy()}
+                client.history[date] = client.shopping_cart.items
+
+            client.money = client.money - price
+            client.spent[date] = client.spent.get(date, 0) + price
 
+        
+            if date in self.history:
+                if client.id in self.history[date]:
+                    for product in client.shopping_cart.items:
+                        if product in self.history[date][client.id]:
+                            self.history[date][client.id][product] += client.shopping_cart.items[product]  
+                        else:
+                            self.history[date][client.id][product] = client.shopping_cart.items[product]
+                else:
+                    # First time to buy for the client to buy on that day
+                    self.history[date][client.id] = client.shopping_cart.items
+            # First purchase of the day
+            else:
+                self.history[date] = {client.id: client.shopping_cart.items.copy()}
+        finally:
+            if tracer is not None:
+                tracer.end()
+
+        # The bought items leave the e-shop
+        items = client.shopping_cart.items
+        for product, amount in items.items():
+            self.reserved[product] = self.reserved.get(product, 0) - amount
+
+        if tracer is not None:
+            tracer.begin("cart empty")
         client.shopping_cart.empty()
+        if tracer is not None:
+            tracer.end()
+
+        # Observers hear about the purchase only once it is complete
+        self._notify(self._purchase_observers, client.id, date, items)
             
     def register_client(self, new_client: Client) -> None:
         """
@@ -226,11 +1316,40 @@ class Shop:
 
         :param new_client: The client that is going to be registered
         """
-        for client in self.clients:
-            if client.id == new_client.id:
-                print("client with that id already exists")
-                return
+        if self.sessions is not None and new_client.id in self.sessions:
+            print("client with that id already exists")
+            return
+        if new_client.id in self._clients_by_id:
+            print("client with that id already exists")
+            return
+        if self.client_history_factory is not None:
+            new_client.history = self.client_history_factory(new_client)
         self.clients.append(new_client)
+        self._clients_by_id[new_client.id] = new_client
+        self._page_in(new_client.id)
+
+    def all_clients(self):
+        """
+        Iterate over every registered client, including the ones evicted to the session store.
+
+        Evicted clients are read from disk one at a time and stay evicted, changes to them are not saved.
+
+        :return: Iterator of clients.
+        """
+        yield from list(self.clients)
+        if self.sessions is not None:
+            yield from self.sessions.evicted_clients()
+
+    def get_client(self, client_id: int) -> Client:
+        """
+        Find a registered client by id.
+
+        :param client_id: Id of the client.
+        :return: The client, or None if no client with that id is registered.
+        """
+        if self.sessions is not None:
+            return self.sessions.touch(client_id)
+        return self._clients_by_id.get(client_id)
 
     def delete_client(self, client: Client) -> None:
         """
@@ -238,11 +1357,16 @@ class Shop:
 
         :param client: The client that is going to be removed
         """
+        self._page_in(client.id)
         for temp_client in self.clients:
             if temp_client == client:
-                for product in client.shopping_cart.items:
-                    self.add_product(product, client.shopping_cart.items[product])
+                self.release_cart(client)
                 self.clients.remove(client)
+                self._clients_by_id.pop(client.id, None)
+                if self.sessions is not None:
+                    self.sessions.forget(client.id)
+                if self.client_history_disposer is not None:
+                    self.client_history_disposer(client.history)
         else:
             print("client does not exist, thus can't remove client from e-shop")
 
@@ -253,10 +1377,7 @@ class Shop:
         :param product: Product that will be added to teh e-shop's inventory.
         :param amount: The amount of specified product that will be asses to the inventory.
         """
-        if product in self.inventory:
-            self.inventory[product] += amount
-        else:
-            self.inventory[product] = amount
+        self._change_inventory(product, amount)
     
     def get_history_descending_date(self) -> dict:
         """
@@ -264,33 +1385,151 @@ class Shop:
 
         :return: History dictionary, that is reversed (I trust that there is no time traveling going on) 
         """
-        return dict(reversed(list(self.history.items())))
+        return dict(reversed(self.history.items()))
     
-    def get_history_verbal(self) -> str:
-        history = self.get_history_descending_date()
-        output = ""
-        for date in history:
-            output += f"On {date}, these purchases were made:\n"
-            for x, client in enumerate(history[date]):
-                last_client = len(history[date]) - x == 1
+    def get_history_verbal(self, workers: int = None, chunk_dates: int = 365) -> str:
+        """
+        History of the e-shop in a human readable tree, newest date first.
+
+        :param workers: Amount of processes that render the report, without it the report is rendered here.
+        :param chunk_dates: How many dates one process renders at a time.
+        :return: A string with the purchases of every date and client.
+        """
+        # Newest date first, one date at a time so histories that live on disk aren't loaded all at once
+        if workers is None:
+            return render_history_days(reversed(self.history.items()))
+
+        days = list(reversed(self.history.items()))
+        chunks = [days[start:start + chunk_dates] for start in range(0, len(days), chunk_dates)]
+        # Every date is a tree of its own, so chunks made of whole dates render the same on their own
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            return "".join(executor.map(render_history_days, chunks))
+
+class ShopFork(Shop):
+    def __init__(self, parent: Shop) -> None:
+        """
+        Initialize a fork of an e-shop, made with Shop.fork().
+
+        Clients are copied the first time the fork touches them, either through the e-shop's
+        methods or get_client. The methods take the parent's client objects too, they are
+        looked up by id.
+
+        :param parent: The e-shop that is forked.
+        """
+        self.inventory = parent.inventory.fork()
+        self.reserved = parent.reserved.fork()
+        self.history = parent.history.fork()
+        self._clients_by_id = parent._clients_by_id.fork()
+        # Ids of the clients that are copies only this fork has
+        self._owned = set()
+        self._init_forks()
+        self._parent = parent
+        self._init_extensions()
+        self.pricing = parent.pricing
+
+    @property
+    def clients(self) -> list:
+        """
+        Registered clients, in the order they registered.
+
+        :return: List of clients.
+        """
+        return list(self._clients_by_id.values())
+
+    def _own_client(self, client: Client) -> Client:
+        """
+        Find the fork's own copy of a client, copying the client if the fork doesn't have one yet.
+
+        :param client: The client or a client with the same id.
+        :return: The fork's copy, or the client itself if no client with that id is registered.
+        """
+        if client.id in self._owned:
+            return self._clients_by_id[client.id]
+        if client.id not in self._clients_by_id:
+            return client
+        copy = _copy_client(self._clients_by_id[client.id])
+        self._clients_by_id[client.id] = copy
+        self._owned.add(client.id)
+        return copy
+
+    def _adopt(self, client: Client) -> None:
+        """
+        Take a copy of a client that the parent is about to change, if this fork still shares it.
+
+        :param client: The client that is about to change.
+        """
+        # Forks of this fork can share the client even if this fork has its own copy by now
+        for fork in list(self._forks):
+            fork._adopt(client)
+        if client.id in self._owned or self._clients_by_id.get(client.id) is not client:
+            return
+        self._clients_by_id[client.id] = _copy_client(client)
+        self._owned.add(client.id)
+
+    def add_to_cart(self, client: Client, product: Product, amount) -> None:
+        super().add_to_cart(self._own_client(client), product, amount)
+
+    def add_many_to_cart(self, client: Client, items: dict) -> None:
+        super().add_many_to_cart(self._own_client(client), items)
+
+    def remove_from_cart(self, client: Client, product: Product, amount: int) -> None:
+        super().remove_from_cart(self._own_client(client), product, amount)
+
+    def buy(self, client: Client, date: datetime.date) -> None:
+        super().buy(self._own_client(client), date)
+
+    def buy_many(self, purchases: list) -> list:
+        return super().buy_many([(self._own_client(client), date) for client, date in purchases])
+
+    def release_cart(self, client: Client) -> None:
+        super().release_cart(self._own_client(client))
+
+    def get_client(self, client_id: int) -> Client:
+        client = self._clients_by_id.get(client_id)
+        return None if client is None else self._own_client(client)
+
+    def register_client(self, new_client: Client) -> None:
+        if new_client.id in self._clients_by_id:
+            print("client with that id already exists")
+            return
+        self._clients_by_id[new_client.id] = new_client
+        self._owned.add(new_client.id)
+
+    def delete_client(self, client: Client) -> None:
+        if client.id not in self._clients_by_id:
+            print("client does not exist, thus can't remove client from e-shop")
+            return
+        self.release_cart(client)
+        del self._clients_by_id[client.id]
+        self._owned.discard(client.id)
+
+def render_history_days(days) -> str:
+    """
+    Render the purchases of dates as the tree used by Shop.get_history_verbal.
+
+    :param days: (date, {client id: {product: amount, ...}, ...}) tuples in the order they are rendered.
+    :return: The rendered dates.
+    """
+    output = ""
+    for date, purchases in days:
+        output += f"On {date}, these purchases were made:\n"
+        for x, client in enumerate(purchases):
+            last_client = len(purchases) - x == 1
+            if last_client:
+                output += f"└id: {client}\n"
+            else:
+                output += f"├id: {client}\n"
+            
+            for y, product in enumerate(purchases[client]):
+                last_product = len(purchases[client]) - y == 1
                 if last_client:
-                    output += f"└id: {client}\n"
+                    if last_product:
+                        output += f" └{purchases[client][product]}x {product}\n"
+                    else:
+                        output += f" ├{purchases[client][product]}x {product}\n"
                 else:
-                    output += f"├id: {client}\n"
-                
-                for y, product in enumerate(history[date][client]):
-                    last_product = len(history[date][client]) - y == 1
-                    if last_client:
-                        if last_product:
-                            output += f" └{history[date][client][product]}x {product}\n"
-                        else:
-                            output += f" ├{history[date][client][product]}x {product}\n"
+                    if last_product:
+                        output += f"│└{purchases[client][product]}x {product}\n"
                     else:
-                        if last_product:
-                            output += f"│└{history[date][client][product]}x {product}\n"
-                        else:
-                            output += f"│├{history[date][client][product]}x {product}\n"
-
-        output.rstrip("\n")
-
-        return output
\ No newline at end of file
+                        output += f"│├{purchases[client][product]}x {product}\n"
+    return output
\ No newline at end of file
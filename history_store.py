@@ -0,0 +1,671 @@
+import collections
+import collections.abc
+import datetime
+import dbm
+import io
+import itertools
+import os
+import pickle
+import tempfile
+import weakref
+import zlib
+
+from epood import Client, Product, Shop
+
+class _SegmentPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        """Store products by name, so they are the shop's own objects again when loaded."""
+        if isinstance(obj, Product):
+            return obj.name
+        return None
+
+class _SegmentUnpickler(pickle.Unpickler):
+    def __init__(self, file, resolve_product) -> None:
+        """Unpickler that looks products up by name."""
+        super().__init__(file)
+        self.resolve_product = resolve_product
+
+    def persistent_load(self, name: str) -> Product:
+        """Turn a stored product name back into the product."""
+        return self.resolve_product(name)
+
+class SegmentCache:
+    def __init__(self, capacity: int = 16) -> None:
+        """
+        Initialize a least recently used cache of loaded history segments.
+
+        One cache can be shared by every TieredHistory of a shop, so the amount of
+        cold history in memory is bounded for the whole shop.
+
+        :param capacity: How many segments are kept in memory.
+        """
+        self.capacity = capacity
+        self._segments = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path: str, resolve_product) -> dict:
+        """
+        Get the contents of a segment, reading it from disk if it isn't cached.
+
+        :param path: Path of the segment file.
+        :param resolve_product: Function that returns the product for a product name.
+        :return: The segment as {date: value, ...}.
+        """
+        segment = self._segments.get(path)
+        if segment is not None:
+            self.hits += 1
+            self._segments.move_to_end(path)
+            return segment
+
+        self.misses += 1
+        with open(path, "rb") as file:
+            data = zlib.decompress(file.read())
+        segment = _SegmentUnpickler(io.BytesIO(data), resolve_product).load()
+        self._segments[path] = segment
+        if len(self._segments) > self.capacity:
+            self._segments.popitem(last=False)
+        return segment
+
+    def forget(self, path: str) -> None:
+        """
+        Drop a segment from the cache.
+
+        :param path: Path of the segment file.
+        """
+        self._segments.pop(path, None)
+
+class ClientStore:
+    def __init__(self, shop: Shop, path: str, capacity: int = 1000) -> None:
+        """
+        Initialize a least recently used set of active clients, the idle ones are kept on disk.
+
+        Evicted clients leave the shop's client list and are written with their shopping cart,
+        history and money to a dbm file. Their reservations stay in the shop, so the stock of
+        their carts isn't sold to anyone else while they are away. A client comes back on its
+        next use, as the same object if the program still refers to it, otherwise read from disk.
+
+        :param shop: The shop whose clients are evicted.
+        :param path: Path of the dbm file, a file that is already there is emptied.
+        :param capacity: How many clients are kept in memory.
+        """
+        self.shop = shop
+        self.path = path
+        self.capacity = capacity
+        self._db = dbm.open(path, "n")
+        # {client id: None} with the least recently used client first
+        self._recent = collections.OrderedDict()
+        # Evicted clients that are still around, they come back without reading the disk
+        self._evicted = weakref.WeakValueDictionary()
+        self._products = {}
+        self.page_ins = 0
+        self.evictions = 0
+
+    def __contains__(self, client_id: int) -> bool:
+        """
+        Check if a client is evicted.
+
+        :param client_id: Id of the client.
+        :return: True if the client is on disk.
+        """
+        return str(client_id) in self._db
+
+    def __len__(self) -> int:
+        """
+        Amount of evicted clients.
+
+        :return: How many clients are on disk.
+        """
+        return len(self._db)
+
+    def _resolve_product(self, name: str) -> Product:
+        """Find a product of the shop by name."""
+        if name not in self._products:
+            self._products = {product.name: product for product in self.shop.inventory}
+        return self._products[name]
+
+    def touch(self, client_id: int) -> Client:
+        """
+        Mark a client as recently used, bringing it back from disk if it was evicted.
+
+        :param client_id: Id of the client.
+        :return: The client, or None if no client with that id is registered.
+        """
+        client = self.shop._clients_by_id.get(client_id)
+        if client is None:
+            key = str(client_id)
+            if key not in self._db:
+                return None
+            client = self._evicted.pop(client_id, None)
+            if client is None:
+                client = _SegmentUnpickler(io.BytesIO(self._db[key]), self._resolve_product).load()
+            del self._db[key]
+            self.shop.clients.append(client)
+            self.shop._clients_by_id[client_id] = client
+            self.page_ins += 1
+
+        self._recent[client_id] = None
+        self._recent.move_to_end(client_id)
+        while len(self._recent) > self.capacity:
+            self._evict(self._recent.popitem(last=False)[0])
+        return client
+
+    def evicted_clients(self):
+        """
+        Iterate over the evicted clients without bringing them back to the shop.
+
+        :return: Iterator of clients, read from disk unless the program still holds them.
+        """
+        for key in list(self._db.keys()):
+            client_id = int(key)
+            client = self._evicted.get(client_id)
+            if client is None:
+                client = _SegmentUnpickler(io.BytesIO(self._db[key]), self._resolve_product).load()
+            yield client
+
+    def _evict(self, client_id: int) -> None:
+        """Write a client to disk and drop it from the shop."""
+        client = self.shop._clients_by_id.pop(client_id)
+        self.shop.clients.remove(client)
+        data = io.BytesIO()
+        _SegmentPickler(data).dump(client)
+        self._db[str(client_id)] = data.getvalue()
+        self._evicted[client_id] = client
+        self.evictions += 1
+
+    def forget(self, client_id: int) -> None:
+        """
+        Stop tracking a client that was deleted from the shop.
+
+        :param client_id: Id of the client.
+        """
+        self._recent.pop(client_id, None)
+        self._evicted.pop(client_id, None)
+        key = str(client_id)
+        if key in self._db:
+            del self._db[key]
+
+    def close(self) -> None:
+        """
+        Bring every evicted client back to the shop and close the dbm file.
+        """
+        self.capacity = len(self._recent) + len(self._db)
+        for key in list(self._db.keys()):
+            self.touch(int(key))
+        self._db.close()
+        self.shop.sessions = None
+
+class TieredHistory(collections.abc.MutableMapping):
+    def __init__(self, directory: str, prefix: str, resolve_product, cache: SegmentCache,
+                 hot_days: int = 30, hot_entries: int = None, segment_days: int = 7) -> None:
+        """
+        Initialize a history that keeps recent dates in memory and older ones on disk.
+
+        Reading a cold date with [] brings it back to memory, because the shop changes
+        the returned dictionaries in place. items() and values() read cold dates through
+        the segment cache without bringing them back, which is what the reports use.
+
+        :param directory: Directory where the segment files are written.
+        :param prefix: Start of the segment file names, has to be unique per history.
+        :param resolve_product: Function that returns the product for a product name.
+        :param cache: Segment cache used for reading cold dates.
+        :param hot_days: Most dates that are kept in memory, when there are more the oldest segment_days go to disk.
+        :param hot_entries: Optional budget of product entries kept in memory.
+        :param segment_days: How many dates are written into one segment.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.resolve_product = resolve_product
+        self.cache = cache
+        self.hot_days = hot_days
+        self.hot_entries = hot_entries
+        self.segment_days = segment_days
+        self._hot = {}
+        # {date: segment path} for every date that lives on disk
+        self._cold = {}
+        # {segment path: amount of its dates that still live there}, a segment nobody uses is deleted
+        self._segment_dates = {}
+        # Every date in the order it was first added, whichever tier it is in
+        self._order = {}
+        self._segment_count = 0
+
+    def __contains__(self, date) -> bool:
+        """
+        Check if the history has the date, without reading from disk.
+
+        :param date: The date that is looked up.
+        :return: True if something was bought on that date.
+        """
+        return date in self._hot or date in self._cold
+
+    def __getitem__(self, date):
+        """
+        Get the purchases of a date, a cold date is moved back to memory.
+
+        :param date: The date that is looked up.
+        :return: The purchases of that date.
+        """
+        if date in self._hot:
+            return self._hot[date]
+        if date not in self._cold:
+            raise KeyError(date)
+
+        segment = self.cache.load(self._cold[date], self.resolve_product)
+        # The segment in the cache is shared, the caller gets its own copy to change
+        value = _copy_value(segment[date])
+        self._drop_cold(date)
+        self._hot[date] = value
+        # The caller is about to change the date, so it stays in memory for now
+        self._evict(keep=date)
+        return value
+
+    def __setitem__(self, date, value) -> None:
+        """
+        Set the purchases of a date and move old dates to disk if memory is over budget.
+
+        :param date: The date that is set.
+        :param value: The purchases of that date.
+        """
+        if date in self._cold:
+            self._drop_cold(date)
+        else:
+            self._order.setdefault(date)
+        is_new = date not in self._hot
+        self._hot[date] = value
+        if is_new:
+            self._evict()
+
+    def __delitem__(self, date) -> None:
+        """
+        Remove a date from the history.
+
+        :param date: The date that is removed.
+        """
+        if date in self._hot:
+            del self._hot[date]
+        elif date in self._cold:
+            self._drop_cold(date)
+        else:
+            raise KeyError(date)
+        del self._order[date]
+
+    def trim(self) -> None:
+        """
+        Move old dates to disk if memory is over budget, for when dates in memory grew in place.
+        """
+        self._evict()
+
+    def drop(self) -> None:
+        """
+        Empty the history and delete its segment files.
+        """
+        for path in self._segment_dates:
+            self.cache.forget(path)
+            os.remove(path)
+        self._segment_dates = {}
+        self._hot = {}
+        self._cold = {}
+        self._order = {}
+
+    def _drop_cold(self, date) -> None:
+        """Forget where a date lives on disk, deleting its segment when no other date lives there."""
+        path = self._cold.pop(date)
+        self._segment_dates[path] -= 1
+        if self._segment_dates[path] == 0:
+            del self._segment_dates[path]
+            self.cache.forget(path)
+            os.remove(path)
+
+    def __iter__(self):
+        """
+        Iterate over the dates in the order they were added, like a dictionary.
+
+        :return: Iterator of dates.
+        """
+        yield from list(self._order)
+
+    def __len__(self) -> int:
+        """
+        Amount of dates in the history.
+
+        :return: How many dates are in memory and on disk together.
+        """
+        return len(self._hot) + len(self._cold)
+
+    def peek(self, date):
+        """
+        Read the purchases of a date without moving it back to memory. Don't change the result.
+
+        :param date: The date that is looked up.
+        :return: The purchases of that date.
+        """
+        if date in self._hot:
+            return self._hot[date]
+        if date not in self._cold:
+            raise KeyError(date)
+        return self.cache.load(self._cold[date], self.resolve_product)[date]
+
+    def __reversed__(self):
+        """
+        Iterate over the dates backwards.
+
+        :return: Iterator of dates.
+        """
+        yield from reversed(list(self._order))
+
+    def items(self):
+        """
+        View of (date, purchases) pairs that reads cold dates through the segment cache.
+
+        :return: Items view that can also be iterated backwards.
+        """
+        return _TieredItems(self)
+
+    @property
+    def hot_dates(self) -> int:
+        """
+        Amount of dates kept in memory.
+
+        :return: How many dates are in memory.
+        """
+        return len(self._hot)
+
+    def _over_budget(self) -> bool:
+        """Check if memory holds more dates or entries than allowed."""
+        if len(self._hot) > self.hot_days:
+            return True
+        if self.hot_entries is None:
+            return False
+        return sum(_count_entries(value) for value in self._hot.values()) > self.hot_entries
+
+    def _evict(self, keep=None) -> None:
+        """Write the oldest dates in memory into new segments until memory is within budget, except keep."""
+        while self._over_budget() and len(self._hot) > 1:
+            oldest = sorted(date for date in self._hot if date != keep)[:self.segment_days]
+            # Always keep at least one date in memory
+            if len(oldest) == len(self._hot):
+                oldest = oldest[:-1]
+            if not oldest:
+                return
+            self.spill(oldest)
+
+    def spill(self, dates: list) -> None:
+        """
+        Write dates from memory into a new compressed segment on disk.
+
+        :param dates: The dates that are moved out of memory.
+        """
+        segment = {date: self._hot[date] for date in dates}
+        path = os.path.join(self.directory, f"{self.prefix}-{self._segment_count:08d}.seg")
+        self._segment_count += 1
+
+        buffer = io.BytesIO()
+        _SegmentPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(segment)
+        with open(path, "wb") as file:
+            file.write(zlib.compress(buffer.getvalue()))
+
+        self.cache.forget(path)
+        self._segment_dates[path] = len(dates)
+        for date in dates:
+            del self._hot[date]
+            self._cold[date] = path
+
+class _TieredItems(collections.abc.ItemsView):
+    def __iter__(self):
+        """Iterate over (date, purchases) pairs without moving cold dates back to memory."""
+        for date in self._mapping:
+            yield date, self._mapping.peek(date)
+
+    def __reversed__(self):
+        """Iterate over (date, purchases) pairs backwards without moving cold dates back to memory."""
+        for date in reversed(self._mapping):
+            yield date, self._mapping.peek(date)
+
+class DayBucketHistory(collections.abc.MutableMapping):
+    def __init__(self, history: dict = None) -> None:
+        """
+        Initialize a history kept in a list with one bucket per day.
+
+        Dates are turned into day ordinals at the edge, the list position of a date is its
+        ordinal minus the ordinal of the first day, so no date objects are stored and the
+        dates between two days are a slice of the list. Dates iterate in calendar order.
+
+        :param history: Optional history as {date: value, ...} to start with.
+        """
+        self._first = None
+        self._buckets = []
+        self._count = 0
+        if history:
+            for date, value in history.items():
+                self[date] = value
+
+    def _position(self, date) -> int:
+        """List position of a date, can be outside of the list."""
+        if not isinstance(date, datetime.date) or self._first is None:
+            return -1
+        return date.toordinal() - self._first
+
+    def __contains__(self, date) -> bool:
+        """
+        Check if something was bought on the date.
+
+        :param date: The date that is looked up.
+        :return: True if the date has purchases.
+        """
+        position = self._position(date)
+        return 0 <= position < len(self._buckets) and self._buckets[position] is not None
+
+    def __getitem__(self, date):
+        """
+        Get the purchases of a date.
+
+        :param date: The date that is looked up.
+        :return: The purchases of that date.
+        """
+        position = self._position(date)
+        if 0 <= position < len(self._buckets) and self._buckets[position] is not None:
+            return self._buckets[position]
+        raise KeyError(date)
+
+    def __setitem__(self, date, value) -> None:
+        """
+        Set the purchases of a date, growing the list when the date is outside of it.
+
+        :param date: The date that is set.
+        :param value: The purchases of that date.
+        """
+        if not isinstance(date, datetime.date):
+            raise TypeError("History is keyed by dates")
+        if value is None:
+            raise ValueError("None can't be stored in the history")
+
+        ordinal = date.toordinal()
+        if self._first is None:
+            self._first = ordinal
+        if ordinal < self._first:
+            self._buckets[:0] = [None] * (self._first - ordinal)
+            self._first = ordinal
+        position = ordinal - self._first
+        if position >= len(self._buckets):
+            self._buckets.extend([None] * (position + 1 - len(self._buckets)))
+
+        if self._buckets[position] is None:
+            self._count += 1
+        self._buckets[position] = value
+
+    def __delitem__(self, date) -> None:
+        """
+        Remove a date from the history.
+
+        :param date: The date that is removed.
+        """
+        if date not in self:
+            raise KeyError(date)
+        self._buckets[self._position(date)] = None
+        self._count -= 1
+
+    def __iter__(self):
+        """
+        Iterate over the dates, oldest first.
+
+        :return: Iterator of dates.
+        """
+        for position, value in enumerate(self._buckets):
+            if value is not None:
+                yield datetime.date.fromordinal(self._first + position)
+
+    def __reversed__(self):
+        """
+        Iterate over the dates, newest first.
+
+        :return: Iterator of dates.
+        """
+        for position in range(len(self._buckets) - 1, -1, -1):
+            if self._buckets[position] is not None:
+                yield datetime.date.fromordinal(self._first + position)
+
+    def __len__(self) -> int:
+        """
+        Amount of dates in the history.
+
+        :return: How many dates have purchases.
+        """
+        return self._count
+
+    def items(self):
+        """
+        View of (date, purchases) pairs that can also be iterated backwards.
+
+        :return: Items view of the history.
+        """
+        return _BucketItems(self)
+
+    def between(self, start: datetime.date, end: datetime.date) -> list:
+        """
+        Get the purchases of a range of dates.
+
+        :param start: First date of the range.
+        :param end: Last date of the range.
+        :return: List of (date, purchases) tuples, oldest first.
+        """
+        if self._first is None:
+            return []
+        first = max(start.toordinal() - self._first, 0)
+        last = min(end.toordinal() - self._first + 1, len(self._buckets))
+        return [(datetime.date.fromordinal(self._first + first + offset), value)
+                for offset, value in enumerate(self._buckets[first:last]) if value is not None]
+
+class _BucketItems(collections.abc.ItemsView):
+    def __iter__(self):
+        """Iterate over (date, purchases) pairs, oldest first."""
+        buckets = self._mapping._buckets
+        for position, value in enumerate(buckets):
+            if value is not None:
+                yield datetime.date.fromordinal(self._mapping._first + position), value
+
+    def __reversed__(self):
+        """Iterate over (date, purchases) pairs, newest first."""
+        buckets = self._mapping._buckets
+        for position in range(len(buckets) - 1, -1, -1):
+            if buckets[position] is not None:
+                yield datetime.date.fromordinal(self._mapping._first + position), buckets[position]
+
+def bucket_history(shop: Shop) -> None:
+    """
+    Move the history of the shop and of its clients into day bucket lists.
+
+    Clients that are registered later get day bucket history as well.
+
+    :param shop: The shop whose history is moved.
+    """
+    if shop.sessions is not None:
+        raise Exception("History can't be moved while clients are evicted")
+    shop.history = DayBucketHistory(shop.history)
+    for client in shop.all_clients():
+        client.history = DayBucketHistory(client.history)
+    shop.client_history_factory = lambda client: DayBucketHistory(client.history)
+
+def _copy_value(value):
+    """Copy nested purchase dictionaries, products themselves are not copied."""
+    if isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+    return value
+
+def _count_entries(value) -> int:
+    """Count the product amounts in nested purchase dictionaries."""
+    if isinstance(value, dict):
+        return sum(_count_entries(item) for item in value.values())
+    return 1
+
+def tier_history(shop: Shop, directory: str, hot_days: int = 30, hot_entries: int = None,
+                 segment_days: int = 7, cache_segments: int = 16) -> SegmentCache:
+    """
+    Move the history of the shop and of its clients into tiered storage.
+
+    Clients that are registered later get tiered history as well. Every call writes into a
+    new directory of its own inside directory, so several shops can share one directory.
+    The segments of a deleted client are deleted with it.
+
+    :param shop: The shop whose history is tiered.
+    :param directory: Directory where the directory of the segment files is made.
+    :param hot_days: How many dates every history keeps in memory.
+    :param hot_entries: Optional budget of product entries every history keeps in memory.
+    :param segment_days: How many dates are written into one segment.
+    :param cache_segments: How many segments the shared cache keeps in memory.
+    :return: The segment cache shared by all the histories.
+    """
+    if shop.sessions is not None:
+        raise Exception("History can't be moved while clients are evicted")
+    os.makedirs(directory, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix="tiers-", dir=directory)
+    # A client id can be registered again after a delete, the number keeps the prefixes apart
+    numbers = itertools.count()
+    cache = SegmentCache(cache_segments)
+    products = {}
+
+    def resolve_product(name: str) -> Product:
+        if name not in products:
+            products.update((product.name, product) for product in shop.inventory)
+        return products[name]
+
+    def tiered(prefix: str, history) -> TieredHistory:
+        store = TieredHistory(directory, f"{prefix}-{next(numbers)}", resolve_product, cache, hot_days, hot_entries, segment_days)
+        for date, value in history.items():
+            store[date] = value
+        return store
+
+    shop.history = tiered("shop", shop.history)
+    for client in shop.all_clients():
+        client.history = tiered(f"client-{client.id}", client.history)
+    shop.client_history_factory = lambda client: tiered(f"client-{client.id}", client.history)
+    shop.client_history_disposer = TieredHistory.drop
+
+    if hot_entries is not None:
+        # Buying on a date that is already in memory grows it in place, the entry budget is checked again after
+        def trim(client_id: int, date: datetime.date, items: dict) -> None:
+            shop.history.trim()
+            client = shop.get_client(client_id)
+            if client is not None and isinstance(client.history, TieredHistory):
+                client.history.trim()
+
+        shop.add_observer(purchase=trim)
+    return cache
+
+def page_clients(shop: Shop, path: str, capacity: int = 1000) -> ClientStore:
+    """
+    Keep only the recently used clients of the shop in memory, the others are evicted to disk.
+
+    Evicted clients come back when they are used through the shop: add_to_cart, buy, get_client and the rest.
+
+    :param shop: The shop whose clients are evicted.
+    :param path: Path of the dbm file.
+    :param capacity: How many clients are kept in memory.
+    :return: The store of evicted clients.
+    """
+    if shop.client_history_factory is not None:
+        raise Exception("Clients with tiered or bucketed history can't be evicted")
+    store = ClientStore(shop, path, capacity)
+    shop.sessions = store
+    for client in list(shop.clients):
+        store.touch(client.id)
+    return store
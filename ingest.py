@@ -0,0 +1,183 @@
+import collections
+import concurrent.futures
+import datetime
+import json
+
+from epood import Shop
+
+class IngestReport:
+    def __init__(self) -> None:
+        """
+        Initialize the report of an ingestion run.
+        """
+        self.orders = 0
+        self.applied = 0
+        # [(line number, message), ...]
+        self.errors = []
+
+    def __repr__(self) -> str:
+        """
+        Representor of the report.
+
+        :return: how many orders were applied and how many failed.
+        """
+        return f"{self.applied}/{self.orders} orders applied, {len(self.errors)} errors"
+
+def read_chunks(path: str, chunk_size: int):
+    """
+    Read a JSON Lines file lazily in chunks of lines.
+
+    :param path: Path of the file.
+    :param chunk_size: How many lines are in one chunk.
+    :return: Generator of (number of the first line, [line, ...]) tuples.
+    """
+    with open(path, encoding="utf-8") as file:
+        chunk = []
+        first_line = 1
+        for line_number, line in enumerate(file, 1):
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield first_line, chunk
+                chunk = []
+                first_line = line_number + 1
+        if chunk:
+            yield first_line, chunk
+
+def parse_chunk(first_line: int, lines: list) -> tuple:
+    """
+    Parse the orders in a chunk of lines.
+
+    An order looks like {"client": 1, "date": "2024-01-31", "items": {"Apple": 2}}.
+
+    :param first_line: Number of the first line in the chunk.
+    :param lines: The lines of the chunk.
+    :return: ([(line number, client id, date, {product name: amount}), ...], [(line number, message), ...])
+    """
+    orders = []
+    errors = []
+    for line_number, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        try:
+            order = json.loads(line)
+            items = order["items"]
+            if not isinstance(items, dict) or not items:
+                raise ValueError("items must be a non-empty object")
+            amounts = {}
+            for name, amount in items.items():
+                if not isinstance(amount, int) or amount <= 0:
+                    raise ValueError(f"amount of {name} must be a positive integer")
+                amounts[name] = amount
+            orders.append((line_number, order["client"], datetime.date.fromisoformat(order["date"]), amounts))
+        except KeyError as error:
+            errors.append((line_number, f"missing field {error}"))
+        except (ValueError, TypeError) as error:
+            errors.append((line_number, str(error)))
+    return orders, errors
+
+class _ChunkApplier:
+    def __init__(self, shop: Shop, report: IngestReport) -> None:
+        """Applies parsed chunks of orders to the shop."""
+        self.shop = shop
+        self.report = report
+        self.products = {}
+
+    def _resolve_products(self, names: set) -> None:
+        """Make sure every product name in a chunk can be looked up, reading the inventory only on a miss."""
+        if not names <= self.products.keys():
+            self.products = {product.name: product for product in self.shop.inventory}
+
+    def apply(self, orders: list, errors: list) -> None:
+        """Put the orders of a chunk into carts and check them out in batches."""
+        self.report.orders += len(orders) + len(errors)
+        self.report.errors.extend(errors)
+        self._resolve_products({name for order in orders for name in order[3]})
+
+        # [(line number, client, date)], a client shows up at most once per batch
+        batch = []
+        in_batch = set()
+        for line_number, client_id, date, amounts in orders:
+            client = self.shop.get_client(client_id)
+            if client is None:
+                self.report.errors.append((line_number, "Client has not registered"))
+                continue
+            missing = [name for name in amounts if name not in self.products]
+            if missing:
+                self.report.errors.append((line_number, f"Unknown product {missing[0]}"))
+                continue
+
+            # The same client again, check out what is in the cart before adding the next order
+            if client.id in in_batch:
+                self._checkout(batch)
+                batch = []
+                in_batch = set()
+            if client.shopping_cart.items:
+                self.report.errors.append((line_number, "Client already has items in the shopping cart"))
+                continue
+
+            try:
+                self.shop.add_many_to_cart(client, {self.products[name]: amount for name, amount in amounts.items()})
+            except Exception as error:
+                self.report.errors.append((line_number, str(error)))
+                continue
+            batch.append((line_number, client, date))
+            in_batch.add(client.id)
+
+        self._checkout(batch)
+
+    def _checkout(self, batch: list) -> None:
+        """Buy a batch of carts and put back the items of the ones that could not be bought."""
+        try:
+            results = self.shop.buy_many([(client, date) for line_number, client, date in batch])
+        except Exception as error:
+            # Carts that are still full weren't bought, they give their stock back and the ingestion goes on
+            for line_number, client, date in batch:
+                if not client.shopping_cart.items:
+                    self.report.applied += 1
+                    continue
+                self.report.errors.append((line_number, f"Checkout failed: {error}"))
+                self.shop.release_cart(client)
+            return
+        for (line_number, client, date), bought in zip(batch, results):
+            if bought:
+                self.report.applied += 1
+                continue
+            self.report.errors.append((line_number, "Client has insufficient funds"))
+            self.shop.release_cart(client)
+
+def ingest_orders(shop: Shop, path: str, chunk_size: int = 1000, workers: int = None, max_pending: int = 4) -> IngestReport:
+    """
+    Replay orders from a JSON Lines file into the shop.
+
+    The file is read lazily one chunk at a time. With workers, chunks are parsed in a process
+    pool while earlier chunks are applied, at most max_pending chunks are waiting at once so
+    a slow shop holds back the reading instead of filling memory. Bad rows are reported and
+    skipped, the other orders still go through.
+
+    :param shop: The shop that the orders are applied to.
+    :param path: Path of the JSON Lines file.
+    :param chunk_size: How many lines are parsed and applied together.
+    :param workers: Amount of processes that parse chunks, without it chunks are parsed in this process.
+    :param max_pending: Most parsed or parsing chunks that wait to be applied.
+    :return: Report of the applied orders and the errors per line.
+    """
+    report = IngestReport()
+    applier = _ChunkApplier(shop, report)
+
+    if workers is None:
+        for first_line, lines in read_chunks(path, chunk_size):
+            applier.apply(*parse_chunk(first_line, lines))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            for first_line, lines in read_chunks(path, chunk_size):
+                pending.append(executor.submit(parse_chunk, first_line, lines))
+                # Chunks are applied in file order, waiting for the oldest one is the backpressure
+                if len(pending) >= max_pending:
+                    applier.apply(*pending.popleft().result())
+            while pending:
+                applier.apply(*pending.popleft().result())
+
+    # Checkout errors are found after the parse errors of the same chunk
+    report.errors.sort(key=lambda error: error[0])
+    return report
@@ -0,0 +1,222 @@
+import bisect
+import datetime
+
+from epood import Product, ShoppingCart
+
+class BulkTier:
+    def __init__(self, product: Product, min_amount: int, unit_price: float) -> None:
+        """
+        Initialize a bulk quantity tier.
+
+        :param product: Product that the tier applies to.
+        :param min_amount: From how many items in the cart the tier starts.
+        :param unit_price: Price of one item inside the tier.
+        """
+        self.product = product
+        self.min_amount = min_amount
+        self.unit_price = unit_price
+
+class Bundle:
+    def __init__(self, products: dict, price: float) -> None:
+        """
+        Initialize a product bundle.
+
+        :param products: Products in the bundle as {product: amount, ...}.
+        :param price: Price of the whole bundle.
+        """
+        self.products = products
+        self.price = price
+
+class Promotion:
+    def __init__(self, product: Product, discount: float, start: datetime.date, end: datetime.date) -> None:
+        """
+        Initialize a date-bounded promotion.
+
+        :param product: Product that is on sale.
+        :param discount: Part of the price that is taken off, 0.2 means 20%.
+        :param start: First day of the promotion.
+        :param end: Last day of the promotion.
+        """
+        self.product = product
+        self.discount = discount
+        self.start = start
+        self.end = end
+
+    def active(self, date: datetime.date) -> bool:
+        """
+        Check if the promotion is running.
+
+        :param date: Day that is checked.
+        :return: True if the promotion applies on that day.
+        """
+        return self.start <= date <= self.end
+
+class PriceTable:
+    def __init__(self, rules: list, date: datetime.date) -> None:
+        """
+        Compile the rules that are active on a date into lookup tables.
+
+        Every product gets a multiplier from its best promotion and a sorted list of tier
+        thresholds with matching unit prices, bundles are indexed by the products in them.
+
+        :param rules: BulkTier, Bundle and Promotion objects.
+        :param date: Day for which the table is compiled.
+        """
+        self.date = date
+        self.multipliers = {}
+        # {product: ([min_amount, ...], [unit_price, ...])}, thresholds ascending
+        self.tiers = {}
+        self.bundles = []
+        # {product: [bundle index, ...]}
+        self.bundles_by_product = {}
+
+        for rule in rules:
+            if isinstance(rule, Promotion) and rule.active(date):
+                multiplier = 1 - rule.discount
+                # Overlapping promotions don't stack, the best one wins
+                if multiplier < self.multipliers.get(rule.product, 1):
+                    self.multipliers[rule.product] = multiplier
+
+        tiers = {}
+        for rule in rules:
+            if isinstance(rule, BulkTier):
+                tiers.setdefault(rule.product, []).append((rule.min_amount, rule.unit_price))
+
+        for product, product_tiers in tiers.items():
+            product_tiers.sort(key=lambda tier: tier[0])
+            multiplier = self.multipliers.get(product, 1)
+            self.tiers[product] = ([tier[0] for tier in product_tiers],
+                                   [tier[1] * multiplier for tier in product_tiers])
+
+        # Bundle savings are measured against the final unit prices, so they go last
+        for rule in rules:
+            if isinstance(rule, Bundle):
+                self._add_bundle(rule)
+
+    def _add_bundle(self, bundle: Bundle) -> None:
+        """
+        Add a bundle to the table, together with how much it saves compared to the unit prices.
+
+        :param bundle: The bundle that is added.
+        """
+        list_price = sum(self.unit_price(product, 1) * amount for product, amount in bundle.products.items())
+        saving = list_price - bundle.price
+        # A bundle that is more expensive than its parts is never worth applying
+        if saving <= 0:
+            return
+
+        self.bundles.append((saving, bundle))
+        index = len(self.bundles) - 1
+        for product in bundle.products:
+            self.bundles_by_product.setdefault(product, []).append(index)
+
+    def unit_price(self, product: Product, amount: int) -> float:
+        """
+        Look up the unit price of a product when buying the given amount.
+
+        :param product: Product that is priced.
+        :param amount: How many items of the product are bought.
+        :return: Price of one item.
+        """
+        price = product.price * self.multipliers.get(product, 1)
+        tiers = self.tiers.get(product)
+        if tiers is not None:
+            position = bisect.bisect_right(tiers[0], amount) - 1
+            if position >= 0:
+                price = min(price, tiers[1][position])
+        return price
+
+    def price(self, items: dict) -> float:
+        """
+        Price the products of a shopping cart.
+
+        :param items: Products and amounts as {product: amount, ...}.
+        :return: Total price before any membership discount.
+        """
+        total = 0
+        candidates = set()
+        for product in items:
+            candidates.update(self.bundles_by_product.get(product, ()))
+
+        remaining = items
+        if candidates:
+            remaining = dict(items)
+            # Apply the bundles that save the most first
+            for index in sorted(candidates, key=lambda index: -self.bundles[index][0]):
+                bundle = self.bundles[index][1]
+                count = min(remaining.get(product, 0) // amount for product, amount in bundle.products.items())
+                if count == 0:
+                    continue
+                total += count * bundle.price
+                for product, amount in bundle.products.items():
+                    remaining[product] -= count * amount
+
+        for product, amount in remaining.items():
+            if amount:
+                total += self.unit_price(product, amount) * amount
+        return total
+
+class PricingEngine:
+    def __init__(self, rules: list = None) -> None:
+        """
+        Initialize the pricing engine.
+
+        :param rules: Optional starting list of BulkTier, Bundle and Promotion objects.
+        """
+        self.rules = list(rules) if rules else []
+        self._tables = {}
+
+    def add_rule(self, rule) -> None:
+        """
+        Add a pricing rule. Compiled tables are thrown away and rebuilt when next needed.
+
+        :param rule: BulkTier, Bundle or Promotion object.
+        """
+        if not isinstance(rule, (BulkTier, Bundle, Promotion)):
+            raise Exception("Unknown pricing rule")
+        self.rules.append(rule)
+        self._tables = {}
+
+    def compile(self, date: datetime.date) -> PriceTable:
+        """
+        Get the compiled price table for a day.
+
+        :param date: Day for which the prices are looked up.
+        :return: The compiled price table.
+        """
+        table = self._tables.get(date)
+        if table is None:
+            table = PriceTable(self.rules, date)
+            self._tables[date] = table
+        return table
+
+    def price(self, shopping_cart: ShoppingCart, date: datetime.date, discount: float = 0) -> float:
+        """
+        Calculate what the shopping cart costs.
+
+        :param shopping_cart: The shopping cart that is priced.
+        :param date: Day of the purchase, decides which promotions are active.
+        :param discount: Membership discount of the client.
+        :return: Price of the shopping cart.
+        """
+        value = self.compile(date).price(shopping_cart.items)
+        return value - value * discount
+
+    def price_batch(self, shopping_carts: list, date: datetime.date, discounts: list = None) -> list:
+        """
+        Calculate the prices of many shopping carts with the same compiled table.
+
+        :param shopping_carts: The shopping carts that are priced.
+        :param date: Day of the purchases.
+        :param discounts: Optional membership discounts, one for every shopping cart.
+        :return: List of prices in the same order as the shopping carts.
+        """
+        table = self.compile(date)
+        if discounts is None:
+            discounts = [0] * len(shopping_carts)
+
+        prices = []
+        for shopping_cart, discount in zip(shopping_carts, discounts):
+            value = table.price(shopping_cart.items)
+            prices.append(value - value * discount)
+        return prices
@@ -0,0 +1,132 @@
+import array
+import bisect
+import datetime
+import heapq
+
+from epood import Product, Shop
+
+class _Postings:
+    def __init__(self) -> None:
+        """Purchases of one product as parallel integer arrays sorted by date ordinal."""
+        self.dates = array.array("q")
+        self.clients = array.array("q")
+        self.amounts = array.array("q")
+
+    def add(self, ordinal: int, client_id: int, amount: int) -> None:
+        """Add a purchase, appending when it's the newest so far."""
+        if not self.dates or self.dates[-1] <= ordinal:
+            self.dates.append(ordinal)
+            self.clients.append(client_id)
+            self.amounts.append(amount)
+            return
+        position = bisect.bisect_right(self.dates, ordinal)
+        self.dates.insert(position, ordinal)
+        self.clients.insert(position, client_id)
+        self.amounts.insert(position, amount)
+
+    def span(self, start: datetime.date, end: datetime.date) -> range:
+        """Positions of the purchases between start and end, both included."""
+        first = 0 if start is None else bisect.bisect_left(self.dates, start.toordinal())
+        last = len(self.dates) if end is None else bisect.bisect_right(self.dates, end.toordinal())
+        return range(first, last)
+
+class PurchaseIndex:
+    def __init__(self) -> None:
+        """
+        Initialize the inverted index from products to the clients that bought them.
+
+        Every product keeps its purchases as sorted integer arrays of date ordinals,
+        client ids and amounts, so date ranges are found with a binary search.
+        """
+        self._postings = {}
+
+    def attach(self, shop: Shop) -> None:
+        """
+        Index the history of the shop and keep up to date with its purchases.
+
+        :param shop: The shop whose purchases are indexed.
+        """
+        for date, purchases in shop.history.items():
+            for client_id, items in purchases.items():
+                self.add_purchase(client_id, date, items)
+        shop.add_observer(purchase=self.add_purchase)
+
+    def detach(self, shop: Shop) -> None:
+        """
+        Stop indexing the purchases of the shop, the index keeps what it has.
+
+        :param shop: The shop the index was attached to.
+        """
+        shop.remove_observer(purchase=self.add_purchase)
+
+    def add_purchase(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """
+        Add a purchase to the index. Has the signature of a Shop purchase observer.
+
+        :param client_id: Id of the client that made the purchase.
+        :param date: Date of the purchase.
+        :param items: The bought products as {product: amount, ...}.
+        """
+        ordinal = date.toordinal()
+        for product, amount in items.items():
+            postings = self._postings.get(product)
+            if postings is None:
+                postings = self._postings[product] = _Postings()
+            postings.add(ordinal, client_id, amount)
+
+    def buyers(self, product: Product, start: datetime.date = None, end: datetime.date = None) -> list:
+        """
+        Find who bought a product and when.
+
+        :param product: The product that is looked up.
+        :param start: Optional first date to include.
+        :param end: Optional last date to include.
+        :return: List of (client id, date, amount) tuples, oldest first.
+        """
+        postings = self._postings.get(product)
+        if postings is None:
+            return []
+        return [(postings.clients[position], datetime.date.fromordinal(postings.dates[position]), postings.amounts[position])
+                for position in postings.span(start, end)]
+
+    def buyers_of_any(self, products: list, start: datetime.date = None, end: datetime.date = None) -> list:
+        """
+        Find the purchases of any of the products, merged by date.
+
+        :param products: The products that are looked up.
+        :param start: Optional first date to include.
+        :param end: Optional last date to include.
+        :return: List of (client id, date, product, amount) tuples, oldest first.
+        """
+        streams = []
+        for position, product in enumerate(products):
+            postings = self._postings.get(product)
+            if postings is not None:
+                # The position breaks ties between products, products themselves can't be compared
+                streams.append([(postings.dates[index], position, postings.clients[index], postings.amounts[index])
+                                for index in postings.span(start, end)])
+
+        return [(client_id, datetime.date.fromordinal(ordinal), products[position], amount)
+                for ordinal, position, client_id, amount in heapq.merge(*streams)]
+
+    def buyers_of_all(self, products: list, start: datetime.date = None, end: datetime.date = None) -> list:
+        """
+        Find the clients that bought every one of the products.
+
+        :param products: The products that are looked up.
+        :param start: Optional first date to include.
+        :param end: Optional last date to include.
+        :return: Sorted list of client ids.
+        """
+        clients = None
+        # Start from the rarest product, so the candidate set is as small as possible from the start
+        for product in sorted(products, key=lambda product: len(self._postings[product].dates) if product in self._postings else 0):
+            postings = self._postings.get(product)
+            if postings is None:
+                return []
+            span = postings.span(start, end)
+            bought = set(postings.clients[span.start:span.stop])
+            clients = bought if clients is None else clients & bought
+            if not clients:
+                return []
+        return sorted(clients) if clients else []
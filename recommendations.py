@@ -0,0 +1,124 @@
+import collections
+import concurrent.futures
+import datetime
+import itertools
+
+from epood import Product, Shop
+
+def _count_pairs(baskets: list) -> collections.Counter:
+    """
+    Count how many baskets every ordered pair of product names appears in.
+
+    :param baskets: Lists of product names.
+    :return: Counter of (name, other name) pairs.
+    """
+    pairs = collections.Counter()
+    for basket in baskets:
+        pairs.update(itertools.permutations(basket, 2))
+    return pairs
+
+class CoOccurrenceIndex:
+    def __init__(self, neighbours: int = 20) -> None:
+        """
+        Initialize the "frequently bought together" index.
+
+        Every product keeps counts for a bounded number of neighbours. When the counts
+        outgrow twice the bound, the rarest neighbours are dropped, so memory grows with
+        the number of products and not with the square of it.
+
+        :param neighbours: How many neighbours every product keeps for sure.
+        """
+        self.neighbours = neighbours
+        # {product: {other product: amount of baskets with both}}
+        self.counts = {}
+        # {product: [other product, ...]} sorted by count, rebuilt after the counts change
+        self._ranked = {}
+
+    def attach(self, shop: Shop) -> None:
+        """
+        Keep the index up to date with the purchases of the shop.
+
+        :param shop: The shop whose purchases are indexed.
+        """
+        shop.add_observer(purchase=self.add_purchase)
+
+    def detach(self, shop: Shop) -> None:
+        """
+        Stop following the purchases of the shop, the counts so far are kept.
+
+        :param shop: The shop the index was attached to.
+        """
+        shop.remove_observer(purchase=self.add_purchase)
+
+    def add_purchase(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """
+        Add a checked out shopping cart. Has the signature of a Shop purchase observer.
+
+        :param client_id: Id of the client that made the purchase.
+        :param date: Date of the purchase.
+        :param items: The bought products as {product: amount, ...}.
+        """
+        self.add_basket(list(items))
+
+    def add_basket(self, products: list, weight: int = 1) -> None:
+        """
+        Count every pair of products in a basket.
+
+        :param products: Products that were bought together.
+        :param weight: How many baskets this counts as.
+        """
+        for product, other in itertools.permutations(products, 2):
+            self._add(product, other, weight)
+
+    def _add(self, product: Product, other: Product, amount: int) -> None:
+        """Add to the count of a pair and keep the neighbours of the product bounded."""
+        counts = self.counts.get(product)
+        if counts is None:
+            counts = self.counts[product] = {}
+        counts[other] = counts.get(other, 0) + amount
+        self._ranked.pop(product, None)
+
+        if len(counts) > 2 * self.neighbours:
+            keep = sorted(counts, key=counts.get, reverse=True)[:self.neighbours]
+            self.counts[product] = {neighbour: counts[neighbour] for neighbour in keep}
+
+    def recommend(self, product: Product, k: int = 5) -> list:
+        """
+        Find the products that are most often bought together with a product.
+
+        :param product: The product that recommendations are made for.
+        :param k: How many products to recommend.
+        :return: Up to k products, the most frequent first.
+        """
+        ranked = self._ranked.get(product)
+        if ranked is None:
+            counts = self.counts.get(product, {})
+            ranked = self._ranked[product] = sorted(counts, key=counts.get, reverse=True)
+        return ranked[:k]
+
+    def backfill(self, shop: Shop, workers: int = None, chunk_dates: int = 30) -> None:
+        """
+        Build the index from the history of the shop, counting chunks of dates in parallel.
+
+        Every client's purchases on one date count as one basket.
+
+        :param shop: The shop whose history is indexed.
+        :param workers: Amount of worker processes, all cores by default.
+        :param chunk_dates: How many dates every worker counts at a time.
+        """
+        products = {product.name: product for product in shop.inventory}
+        chunks = []
+        chunk = []
+        for position, (date, purchases) in enumerate(shop.history.items()):
+            # Only names are sent to the workers, products are looked up again when the counts come back
+            chunk.extend([product.name for product in items] for items in purchases.values())
+            if (position + 1) % chunk_dates == 0:
+                chunks.append(chunk)
+                chunk = []
+        if chunk:
+            chunks.append(chunk)
+
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for pairs in executor.map(_count_pairs, chunks):
+                for (name, other), amount in pairs.items():
+                    self._add(products[name], products[other], amount)
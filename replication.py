@@ -0,0 +1,391 @@
+import datetime
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client as Connect, Listener
+
+from epood import Product, Shop
+
+class ReplicationPrimary:
+    def __init__(self, shop: Shop, address=("localhost", 0), heartbeat: float = 0.1, clock=time.time) -> None:
+        """
+        Start streaming the shop's mutations to replicas.
+
+        Checkout only puts the changes on a queue, a background thread sends them to
+        the replicas, so slow replicas never hold up the shop. Every message carries the
+        time it was queued at, so replicas know how old the state they have reached is.
+
+        :param shop: The shop whose state is replicated.
+        :param address: Address where replicas connect to, the port is picked automatically by default.
+        :param heartbeat: How many seconds of silence before a heartbeat is sent, bounds the staleness of idle replicas.
+        :param clock: Function returning the current time in seconds, replicas have to use the same clock.
+        """
+        self.shop = shop
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.authkey = os.urandom(16)
+        self.listener = Listener(address, authkey=self.authkey)
+        self.sequence = 0
+        self.replicas = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._running = True
+
+        shop.add_observer(inventory=self._inventory_changed, purchase=self._purchased)
+
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender.start()
+
+    @property
+    def address(self):
+        """
+        Address of the primary.
+
+        :return: Address that replicas can connect to.
+        """
+        return self.listener.address
+
+    def _inventory_changed(self, product: Product, delta: int, level: int) -> None:
+        """Queue an inventory change for the replicas."""
+        self.sequence += 1
+        self._queue.put(("inventory", self.sequence, product.name, product.price, level, self.clock()))
+
+    def _purchased(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """Queue the client's merged history entry for the day for the replicas."""
+        self.sequence += 1
+        entry = {product.name: amount for product, amount in self.shop.history[date][client_id].items()}
+        self._queue.put(("purchase", self.sequence, date, client_id, entry, self.clock()))
+
+    def snapshot(self) -> dict:
+        """
+        Take a snapshot of the replicated state.
+
+        :return: Dictionary with the sequence number, time, inventory and history of the shop.
+        """
+        taken = self.clock()
+        inventory = {product.name: (product.price, level) for product, level in self.shop.inventory.items()}
+        history = []
+        for date in self.shop.history:
+            for client_id in self.shop.history[date]:
+                entry = {product.name: amount for product, amount in self.shop.history[date][client_id].items()}
+                history.append((date, client_id, entry))
+        return {"sequence": self.sequence, "time": taken, "inventory": inventory, "history": history}
+
+    def accept(self) -> None:
+        """
+        Wait for a replica to connect and send it a snapshot of the current state.
+
+        Must be called from the thread that uses the shop, so the snapshot is consistent.
+        """
+        connection = self.listener.accept()
+        connection.send(("snapshot", self.snapshot()))
+        with self._lock:
+            self.replicas.append(connection)
+
+    def _send_loop(self) -> None:
+        """Send queued mutations, or heartbeats when there are none, to every replica."""
+        while self._running:
+            try:
+                message = self._queue.get(timeout=self.heartbeat)
+            except queue.Empty:
+                # Time first: a mutation queued in between raises the sequence, so the replica ignores this time
+                now = self.clock()
+                message = ("heartbeat", self.sequence, now)
+
+            with self._lock:
+                for connection in list(self.replicas):
+                    try:
+                        connection.send(message)
+                    except (OSError, EOFError):
+                        # Replica went away, stop streaming to it
+                        self.replicas.remove(connection)
+
+    def close(self) -> None:
+        """
+        Stop replicating and disconnect the replicas.
+        """
+        self._running = False
+        self._sender.join()
+        self.shop.remove_observer(inventory=self._inventory_changed, purchase=self._purchased)
+        with self._lock:
+            for connection in self.replicas:
+                connection.close()
+            self.replicas = []
+        self.listener.close()
+
+class Replica:
+    def __init__(self, address, authkey: bytes, clock=time.time) -> None:
+        """
+        Connect to a primary and keep a read-only copy of its shop.
+
+        :param address: Address of the primary.
+        :param authkey: Authentication key of the primary.
+        :param clock: Function returning the current time in seconds, the same clock as the primary's.
+        """
+        self.clock = clock
+        self.shop = Shop()
+        self.sequence = 0
+        self.products = {}
+        self._lock = threading.Lock()
+        self._connection = Connect(address, authkey=authkey)
+
+        kind, snapshot = self._connection.recv()
+        self._load(snapshot)
+        # Time on the primary that the local state is known to be up to date with
+        self.synced_at = snapshot["time"]
+
+        self._applier = threading.Thread(target=self._apply_loop, daemon=True)
+        self._applier.start()
+
+    def _product(self, name: str, price: float) -> Product:
+        """Find the local copy of a product, products are identified by their name."""
+        product = self.products.get(name)
+        if product is None:
+            product = Product(name, price)
+            self.products[name] = product
+        return product
+
+    def _load(self, snapshot: dict) -> None:
+        """Replace the local state with a snapshot from the primary."""
+        self.sequence = snapshot["sequence"]
+        for name, (price, level) in snapshot["inventory"].items():
+            self.shop.inventory[self._product(name, price)] = level
+        for date, client_id, entry in snapshot["history"]:
+            self._set_history(date, client_id, entry)
+
+    def _set_history(self, date: datetime.date, client_id: int, entry: dict) -> None:
+        """Store a client's history entry for a day."""
+        items = {self.products[name]: amount for name, amount in entry.items()}
+        if date not in self.shop.history:
+            self.shop.history[date] = {}
+        self.shop.history[date][client_id] = items
+
+    def _apply_loop(self) -> None:
+        """Apply the mutations streamed by the primary until it disconnects."""
+        while True:
+            try:
+                message = self._connection.recv()
+            # TypeError is what recv raises when close() was called from another thread meanwhile
+            except (OSError, EOFError, TypeError):
+                return
+
+            with self._lock:
+                if message[0] == "heartbeat":
+                    # A heartbeat only vouches for the time if every mutation before it is applied
+                    if message[1] <= self.sequence:
+                        self.synced_at = max(self.synced_at, message[2])
+                    continue
+                # Mutations that were queued before the snapshot was taken are already in it
+                if message[1] <= self.sequence:
+                    continue
+
+                self.sequence = message[1]
+                if message[0] == "inventory":
+                    kind, sequence, name, price, level, queued = message
+                    self.shop.inventory[self._product(name, price)] = level
+                else:
+                    kind, sequence, date, client_id, entry, queued = message
+                    self._set_history(date, client_id, entry)
+                self.synced_at = max(self.synced_at, queued)
+
+    @property
+    def staleness(self) -> float:
+        """
+        How far behind the primary the replica can be.
+
+        :return: Seconds since the time on the primary of the newest state the replica has applied.
+        """
+        return self.clock() - self.synced_at
+
+    def _check_staleness(self, max_staleness: float) -> None:
+        """Refuse to answer when the data could be older than allowed."""
+        if max_staleness is not None and self.staleness > max_staleness:
+            raise Exception("Replica is too stale")
+
+    def inventory(self, max_staleness: float = None) -> dict:
+        """
+        Inventory of the shop.
+
+        :param max_staleness: How many seconds behind the primary the answer may be.
+        :return: The inventory as {product name: amount, ...}.
+        """
+        with self._lock:
+            self._check_staleness(max_staleness)
+            return {product.name: amount for product, amount in self.shop.inventory.items()}
+
+    def history_descending_date(self, max_staleness: float = None) -> dict:
+        """
+        History of the shop with the dates descending.
+
+        :param max_staleness: How many seconds behind the primary the answer may be.
+        :return: History as {date: {client id: {product name: amount, ...}, ...}, ...}.
+        """
+        with self._lock:
+            self._check_staleness(max_staleness)
+            history = self.shop.get_history_descending_date()
+            return {date: {client_id: {product.name: amount for product, amount in items.items()}
+                           for client_id, items in history[date].items()}
+                    for date in history}
+
+    def history_verbal(self, max_staleness: float = None) -> str:
+        """
+        Human readable history of the shop.
+
+        :param max_staleness: How many seconds behind the primary the answer may be.
+        :return: The same report as Shop.get_history_verbal.
+        """
+        with self._lock:
+            self._check_staleness(max_staleness)
+            return self.shop.get_history_verbal()
+
+    def client_history(self, client_id: int, max_staleness: float = None) -> dict:
+        """
+        Purchases of one client.
+
+        :param client_id: Id of the client.
+        :param max_staleness: How many seconds behind the primary the answer may be.
+        :return: History as {date: {product name: amount, ...}, ...}.
+        """
+        with self._lock:
+            self._check_staleness(max_staleness)
+            return {date: {product.name: amount for product, amount in self.shop.history[date][client_id].items()}
+                    for date in self.shop.history if client_id in self.shop.history[date]}
+
+    def close(self) -> None:
+        """
+        Disconnect from the primary.
+        """
+        self._connection.close()
+
+# Queries that replica processes answer, mapped to Replica methods
+QUERIES = ("inventory", "history_descending_date", "history_verbal", "client_history")
+
+def _serve_query_connection(replica: Replica, connection) -> None:
+    """Answer queries from one connection until it closes."""
+    while True:
+        try:
+            query, args, max_staleness = connection.recv()
+        except (OSError, EOFError):
+            return
+        if query not in QUERIES:
+            connection.send(("error", "Unknown query"))
+            continue
+        try:
+            connection.send(("ok", getattr(replica, query)(*args, max_staleness=max_staleness)))
+        except Exception as error:
+            connection.send(("error", str(error)))
+
+def run_replica(primary_address, authkey: bytes, ready) -> None:
+    """
+    Run a replica process: follow the primary and answer queries until told to stop.
+
+    :param primary_address: Address of the primary.
+    :param authkey: Authentication key of the primary, also used for the query connections.
+    :param ready: Connection where the address for queries is sent once the replica is up.
+    """
+    replica = Replica(primary_address, authkey)
+    listener = Listener(("localhost", 0), authkey=authkey)
+    ready.send(listener.address)
+
+    while True:
+        connection = listener.accept()
+        # The control connection that started the process asks it to stop
+        if connection.poll(0.5) and connection.recv() == "shutdown":
+            connection.close()
+            break
+        threading.Thread(target=_serve_query_connection, args=(replica, connection), daemon=True).start()
+
+    replica.close()
+    listener.close()
+
+class ReplicaClient:
+    def __init__(self, address, authkey: bytes, process: multiprocessing.Process = None) -> None:
+        """
+        Connect to a replica process to send it queries.
+
+        :param address: Query address of the replica.
+        :param authkey: Authentication key of the replica.
+        :param process: The replica process, if it was started by us.
+        """
+        self.address = address
+        self.authkey = authkey
+        self.process = process
+        self._connection = Connect(address, authkey=authkey)
+        # Let the replica know this is a query connection and not a shutdown request
+        self._connection.send(None)
+
+    def _query(self, query: str, *args, max_staleness: float = None):
+        """Send a query and wait for the answer."""
+        self._connection.send((query, args, max_staleness))
+        status, result = self._connection.recv()
+        if status != "ok":
+            raise Exception(result)
+        return result
+
+    def inventory(self, max_staleness: float = None) -> dict:
+        """
+        Inventory of the shop, see Replica.inventory.
+        """
+        return self._query("inventory", max_staleness=max_staleness)
+
+    def history_descending_date(self, max_staleness: float = None) -> dict:
+        """
+        History of the shop, see Replica.history_descending_date.
+        """
+        return self._query("history_descending_date", max_staleness=max_staleness)
+
+    def history_verbal(self, max_staleness: float = None) -> str:
+        """
+        Human readable history of the shop, see Replica.history_verbal.
+        """
+        return self._query("history_verbal", max_staleness=max_staleness)
+
+    def client_history(self, client_id: int, max_staleness: float = None) -> dict:
+        """
+        Purchases of one client, see Replica.client_history.
+        """
+        return self._query("client_history", client_id, max_staleness=max_staleness)
+
+    def shutdown(self) -> None:
+        """
+        Close the connection and stop the replica process if it was started by us.
+        """
+        self._connection.close()
+        if self.process is None:
+            return
+        control = Connect(self.address, authkey=self.authkey)
+        control.send("shutdown")
+        control.close()
+        self.process.join()
+
+def start_replica_process(primary: ReplicationPrimary) -> ReplicaClient:
+    """
+    Start a replica as a local process that follows the primary.
+
+    :param primary: The primary that the replica follows.
+    :return: Client for sending queries to the replica.
+    """
+    ready_receiver, ready_sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_replica, args=(primary.address, primary.authkey, ready_sender),
+                                      daemon=True)
+    process.start()
+    primary.accept()
+    address = ready_receiver.recv()
+    return ReplicaClient(address, primary.authkey, process)
+
+def wait_for_replicas(replicas: list, inventory: dict, timeout: float = 5) -> None:
+    """
+    Wait until every replica shows the given inventory, useful in tests and benchmarks.
+
+    :param replicas: ReplicaClient objects.
+    :param inventory: The inventory as {product name: amount, ...} that the replicas should reach.
+    :param timeout: How many seconds to wait before giving up.
+    """
+    deadline = time.monotonic() + timeout
+    for replica in replicas:
+        while replica.inventory() != inventory:
+            if time.monotonic() > deadline:
+                raise Exception("Replicas did not catch up in time")
+            time.sleep(0.01)
@@ -0,0 +1,376 @@
+import asyncio
+import datetime
+import json
+import math
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from epood import Client, Product, Shop
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        """
+        Initialize an error that is sent back to the client as a JSON response.
+
+        :param status: HTTP status code.
+        :param message: Description of what went wrong.
+        """
+        super().__init__(message)
+        self.status = status
+
+class Request:
+    def __init__(self, method: str, target: str, headers: dict, body: bytes) -> None:
+        """
+        Initialize a parsed HTTP request.
+
+        :param method: HTTP method, like GET or POST.
+        :param target: Request target with the path and query string.
+        :param headers: Headers with lowercase names.
+        :param body: Raw request body.
+        """
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> dict:
+        """
+        Decode the request body.
+
+        :return: The body parsed as a JSON object.
+        """
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+        return data
+
+async def read_request(reader: asyncio.StreamReader):
+    """
+    Read one HTTP/1.1 request from the stream.
+
+    :param reader: The connection's stream reader.
+    :return: The request and whether the connection should be kept open, or None when the client is gone.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        # Not something we can answer, drop the connection
+        return None
+
+    body = b""
+    if length:
+        body = await reader.readexactly(length)
+
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    return Request(method, target, headers, body), keep_alive
+
+def encode_response(status: int, data, keep_alive: bool) -> bytes:
+    """
+    Build an HTTP response with a JSON body.
+
+    :param status: HTTP status code.
+    :param data: Data that is sent as JSON.
+    :param keep_alive: If the connection stays open after the response.
+    :return: The response as bytes.
+    """
+    body = json.dumps(data).encode()
+    head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode() + body
+
+class ShopService:
+    def __init__(self, shop: Shop, batch_window: float = 0.002, max_batch: int = 256) -> None:
+        """
+        Initialize the HTTP/JSON service.
+
+        Checkouts that arrive at about the same time are collected for batch_window seconds
+        and bought together with Shop.buy_many.
+
+        :param shop: The shop that is served.
+        :param batch_window: How many seconds checkouts are collected before they are bought.
+        :param max_batch: Buy right away when this many checkouts are waiting.
+        """
+        self.shop = shop
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.server = None
+        self.products = {}
+        self._pending_checkouts = []
+        self._flush_handle = None
+        self._connections = set()
+        self.routes = {
+            ("POST", "/clients"): self.register,
+            ("POST", "/cart/add"): self.add_to_cart,
+            ("POST", "/cart/remove"): self.remove_from_cart,
+            ("POST", "/buy"): self.buy,
+            ("GET", "/inventory"): self.inventory,
+            ("GET", "/history"): self.history,
+        }
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        """
+        Start listening for connections.
+
+        :param host: Address to listen on.
+        :param port: Port to listen on, picked automatically by default.
+        """
+        self.server = await asyncio.start_server(self._serve_connection, host, port)
+
+    @property
+    def address(self) -> tuple:
+        """
+        Address the service listens on.
+
+        :return: (host, port) tuple.
+        """
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self) -> None:
+        """
+        Stop accepting connections and wind down the open ones.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        # Give connections whose clients already hung up a moment to finish on their own
+        if self._connections:
+            done, pending = await asyncio.wait(self._connections, timeout=1)
+            for task in pending:
+                task.cancel()
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Read pipelined requests and answer them in the order they came in."""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+        responses = asyncio.Queue()
+        responder = asyncio.ensure_future(self._write_responses(responses, writer))
+        try:
+            while True:
+                parsed = await read_request(reader)
+                if parsed is None:
+                    break
+                request, keep_alive = parsed
+                # Requests of one connection are handled in order so a client sees its own writes,
+                # pipelined requests are already buffered and responses are written behind
+                await responses.put((await self._handle(request), keep_alive))
+                if not keep_alive:
+                    break
+        finally:
+            await responses.put(None)
+            await responder
+
+    async def _write_responses(self, responses: asyncio.Queue, writer: asyncio.StreamWriter) -> None:
+        """Write the responses of a connection in request order."""
+        try:
+            while True:
+                item = await responses.get()
+                if item is None:
+                    break
+                (status, data), keep_alive = item
+                writer.write(encode_response(status, data, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, request: Request) -> tuple:
+        """Route a request to its handler and turn errors into JSON responses."""
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for method, path in self.routes):
+                return 405, {"error": "Method not allowed"}
+            return 404, {"error": "Not found"}
+        try:
+            return await handler(request)
+        except HTTPError as error:
+            return error.status, {"error": str(error)}
+        # Missing fields and values that don't parse
+        except (KeyError, ValueError) as error:
+            return 400, {"error": str(error)}
+        except Exception as error:
+            # The shop raises plain Exception for requests it refuses, anything else is a fault of the server
+            if type(error) is Exception:
+                return 400, {"error": str(error)}
+            return 500, {"error": "Internal server error"}
+
+    def _client(self, data: dict) -> Client:
+        """Find the registered client named in the request."""
+        client = self.shop.get_client(data.get("client"))
+        if client is None:
+            raise HTTPError(404, "Unknown client")
+        return client
+
+    def _product(self, data: dict):
+        """Find the product named in the request, products are identified by their name."""
+        name = data.get("product")
+        if name not in self.products:
+            self.products = {product.name: product for product in self.shop.inventory}
+        if name not in self.products:
+            raise HTTPError(404, "Unknown product")
+        return self.products[name]
+
+    async def register(self, request: Request) -> tuple:
+        """Register a new client."""
+        data = request.json()
+        if self.shop.get_client(data.get("id")) is not None:
+            raise HTTPError(400, "Client with that id already exists")
+        self.shop.register_client(Client(data["id"], bool(data.get("membership")), data.get("money", 0)))
+        return 201, {"id": data["id"]}
+
+    async def add_to_cart(self, request: Request) -> tuple:
+        """Add products to a client's shopping cart."""
+        data = request.json()
+        client = self._client(data)
+        self.shop.add_to_cart(client, self._product(data), int(data["amount"]))
+        return 200, {"cart": {product.name: amount for product, amount in client.shopping_cart.items.items()}}
+
+    async def remove_from_cart(self, request: Request) -> tuple:
+        """Remove products from a client's shopping cart."""
+        data = request.json()
+        client = self._client(data)
+        self.shop.remove_from_cart(client, self._product(data), int(data["amount"]))
+        return 200, {"cart": {product.name: amount for product, amount in client.shopping_cart.items.items()}}
+
+    async def buy(self, request: Request) -> tuple:
+        """Check out a client's shopping cart as part of the next batch."""
+        data = request.json()
+        client = self._client(data)
+        date = datetime.date.fromisoformat(data["date"]) if "date" in data else datetime.date.today()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_checkouts.append((client, date, future))
+        if len(self._pending_checkouts) >= self.max_batch:
+            self._flush_checkouts()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_checkouts)
+
+        if not await future:
+            raise HTTPError(400, "Client has insufficient funds")
+        return 200, {"money": client.money}
+
+    def _flush_checkouts(self) -> None:
+        """Buy every waiting checkout in one batch."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending = self._pending_checkouts
+        self._pending_checkouts = []
+        if not pending:
+            return
+
+        try:
+            results = self.shop.buy_many([(client, date) for client, date, future in pending])
+        except Exception as error:
+            # Every request of the batch gets an answer, not just the one whose cart broke it
+            for client, date, future in pending:
+                if not future.done():
+                    future.set_exception(HTTPError(500, f"Checkout failed: {error}"))
+            return
+        for (client, date, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def inventory(self, request: Request) -> tuple:
+        """List the amounts of every product in the inventory."""
+        return 200, {product.name: amount for product, amount in self.shop.inventory.items()}
+
+    async def history(self, request: Request) -> tuple:
+        """List the purchases, newest date first, one page at a time."""
+        try:
+            page = int(request.query.get("page", 1))
+            size = int(request.query.get("size", 50))
+        except ValueError:
+            raise HTTPError(400, "page and size must be numbers")
+        if page < 1 or size < 1:
+            raise HTTPError(400, "page and size must be positive")
+
+        entries = []
+        start = (page - 1) * size
+        total = 0
+        for date, purchases in reversed(list(self.shop.history.items())):
+            for client_id, items in purchases.items():
+                if start <= total < start + size:
+                    entries.append({"date": date.isoformat(), "client": client_id,
+                                    "items": {product.name: amount for product, amount in items.items()}})
+                total += 1
+        return 200, {"page": page, "size": size, "total": total, "items": entries}
+
+async def _load_test_connection(host: str, port: int, client_id: int, requests: int, latencies: list) -> None:
+    """Register a client and run add to cart and buy requests over one keep-alive connection."""
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def call(method: str, path: str, data: dict = None) -> int:
+        body = json.dumps(data).encode() if data is not None else b""
+        started = time.perf_counter()
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        parsed_head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in parsed_head.decode("latin-1").split("\r\n"):
+            if line.lower().startswith("content-length:"):
+                length = int(line.split(":", 1)[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - started)
+        return int(parsed_head.split(b" ", 2)[1])
+
+    await call("POST", "/clients", {"id": client_id, "membership": False, "money": 10 ** 9})
+    for _ in range(requests // 2):
+        await call("POST", "/cart/add", {"client": client_id, "product": "load test product", "amount": 1})
+        await call("POST", "/buy", {"client": client_id, "date": "2024-01-01"})
+
+    writer.close()
+
+async def run_load_test(connections: int = 50, requests: int = 200) -> dict:
+    """
+    Start a service on a local port and hammer it with concurrent keep-alive clients.
+
+    :param connections: How many clients run at the same time.
+    :param requests: How many add to cart and buy requests every client makes.
+    :return: Dictionary with the amount of requests, requests per second and p99 latency in milliseconds.
+    """
+    shop = Shop()
+    shop.add_product(Product("load test product", 1), connections * requests)
+    service = ShopService(shop)
+    await service.start()
+    host, port = service.address
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(_load_test_connection(host, port, client_id, requests, latencies)
+                           for client_id in range(connections)))
+    elapsed = time.perf_counter() - started
+    await service.close()
+
+    latencies.sort()
+    return {"requests": len(latencies),
+            "requests_per_second": len(latencies) / elapsed,
+            "p99_ms": latencies[math.ceil(len(latencies) * 0.99) - 1] * 1000}
+
+if __name__ == "__main__":
+    report = asyncio.run(run_load_test())
+    print(f"{report['requests']} requests, {report['requests_per_second']:.0f} req/s, p99 {report['p99_ms']:.2f} ms")
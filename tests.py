@@ -191,4 +191,934 @@ def test__shop_history_and_client_history_multiple_days():
                                                        2: {apple: 1, banana: 4}}, 
                                                   datetime.date(2020, 1, 2): 
                                                       {1: {apple: 2, banana: 5}, 
-                                                       2: {apple: 2, banana: 4}}} 
\ No newline at end of file
+                                                       2: {apple: 2, banana: 4}}} 
+
+def test__change_feed_coalesces_inventory_and_purchases():
+    shop = Shop()
+    batches = []
+    shop.subscribe(batches.append, window=10)
+
+    bob = Client(1, False, 100)
+    apple = Product("Apple", 1)
+    banana = Product("Banana", 2)
+
+    shop.register_client(bob)
+    shop.add_product(apple, 50)
+    shop.add_product(banana, 5)
+    for _ in range(5):
+        shop.add_to_cart(bob, apple, 2)
+    shop.add_to_cart(bob, banana, 1)
+    shop.remove_from_cart(bob, banana, 1)
+    shop.buy(bob, datetime.date(2021, 3, 4))
+
+    # Window hasn't passed yet, nothing is delivered
+    assert batches == []
+
+    shop.feed.flush()
+
+    assert len(batches) == 1
+    inventory_events = [event for event in batches[0] if isinstance(event, InventoryDelta)]
+    purchase_events = [event for event in batches[0] if isinstance(event, PurchaseEvent)]
+
+    # Banana was added to cart and removed again, so it only shows the restock
+    assert [(event.product, event.delta, event.level) for event in inventory_events] == [(apple, 40, 40), (banana, 5, 5)]
+    assert len(purchase_events) == 1
+    assert purchase_events[0].client_id == 1
+    assert purchase_events[0].items == {apple: 10}
+
+def test__change_feed_delivers_when_window_passes():
+    now = [0.0]
+    feed = ChangeFeed(window=1, clock=lambda: now[0])
+    batches = []
+    feed.subscribe(batches.append)
+
+    apple = Product("Apple", 1)
+
+    feed.publish_inventory(apple, -1, 9)
+    feed.publish_inventory(apple, -1, 8)
+    assert batches == []
+
+    now[0] = 1.5
+    feed.publish_inventory(apple, -1, 7)
+
+    assert len(batches) == 1
+    assert batches[0][0].delta == -3 and batches[0][0].level == 7
+
+    feed.unsubscribe(batches.append)
+    feed.publish_inventory(apple, -1, 6)
+    feed.flush()
+    assert len(batches) == 1
+
+def test__change_feed_flushes_when_traffic_stops():
+    import time
+
+    feed = ChangeFeed(window=0.01)
+    batches = []
+    feed.subscribe(batches.append)
+    feed.publish_inventory(Product("Apple", 1), -1, 9)
+    assert batches == []
+
+    # Nothing else is published, the timer still delivers the batch
+    deadline = time.monotonic() + 2
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(batches) == 1 and batches[0][0].level == 9
+
+    # A zero window delivers right away without starting a timer
+    feed.window = 0
+    feed.publish_inventory(Product("Pear", 1), 1, 1)
+    assert len(batches) == 2 and feed._timer is None
+
+def test__failing_observer_does_not_break_checkout():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+
+    def fail(*args):
+        raise Exception("observer is broken")
+
+    shop.add_observer(inventory=fail, purchase=fail)
+    shop.subscribe(fail, window=0)
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2020, 1, 1))
+    # Buying again with the empty cart doesn't charge or add anything
+    shop.buy(bob, datetime.date(2020, 1, 1))
+
+    assert bob.money == 98 and bob.shopping_cart.items == {}
+    assert shop.history == {datetime.date(2020, 1, 1): {1: {apple: 2}}}
+    assert shop.reserved_stock(apple) == 0 and shop.available(apple) == 8
+
+def test__stock_index_low_and_top_stock():
+    shop = Shop()
+
+    bob = Client(1, False, 1000)
+    apple = Product("Apple", 1)
+    banana = Product("Banana", 1)
+    cherry = Product("Cherry", 1)
+
+    shop.register_client(bob)
+    shop.add_product(apple, 30)
+    shop.add_product(banana, 3)
+
+    crossings = []
+    index = shop.track_stock(threshold=5, on_cross=lambda product, level, below: crossings.append((product, level, below)))
+
+    shop.add_product(cherry, 10)
+    shop.add_to_cart(bob, cherry, 6)
+    shop.add_to_cart(bob, apple, 10)
+
+    assert index.below(5) == [(banana, 3), (cherry, 4)]
+    assert index.top(2) == [(apple, 20), (cherry, 4)]
+    assert crossings == [(cherry, 4, True)]
+
+    shop.remove_from_cart(bob, cherry, 2)
+    assert crossings[-1] == (cherry, 6, False)
+
+    shop.delete_client(bob)
+
+    assert index.below(5) == [(banana, 3)]
+    assert index.level(apple) == 30
+    assert index.top(10) == [(apple, 30), (cherry, 10), (banana, 3)]
+
+def test__pricing_engine_tiers_bundles_and_promotions():
+    from pricing import BulkTier, Bundle, Promotion, PricingEngine
+
+    apple = Product("Apple", 1)
+    phone = Product("Phone", 500)
+    case = Product("Case", 30)
+
+    engine = PricingEngine([BulkTier(apple, 10, 0.8),
+                            BulkTier(apple, 50, 0.5),
+                            Bundle({phone: 1, case: 1}, 510),
+                            Promotion(case, 0.9, datetime.date(2022, 1, 1), datetime.date(2022, 1, 31))])
+
+    cart = ShoppingCart()
+    cart.add(apple, 12)
+    cart.add(phone, 2)
+    cart.add(case, 1)
+
+    # 12 apples hit the first tier, one phone goes into the bundle and the other is full price
+    assert engine.price(cart, datetime.date(2021, 12, 31)) == 12 * 0.8 + 510 + 500
+
+    # During the promotion the case is cheap enough that the bundle doesn't save anything
+    assert round(engine.price(cart, datetime.date(2022, 1, 15)), 2) == 12 * 0.8 + 2 * 500 + 3
+
+    small_cart = ShoppingCart()
+    small_cart.add(apple, 60)
+    assert engine.price_batch([cart, small_cart], datetime.date(2021, 12, 31), [0.1, 0]) == \
+        [(12 * 0.8 + 510 + 500) * 0.9, 60 * 0.5]
+
+def test__buy_with_pricing_engine():
+    from pricing import BulkTier, PricingEngine
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    james = Client(5, True, 100)
+
+    shop.register_client(james)
+    shop.add_product(apple, 100)
+    shop.pricing = PricingEngine([BulkTier(apple, 20, 0.5)])
+
+    shop.add_to_cart(james, apple, 40)
+    shop.buy(james, datetime.date(2022, 2, 2))
+
+    assert round(james.money, 2) == 100 - 40 * 0.5 * 0.9
+
+def test__replicas_follow_primary_in_separate_processes():
+    from replication import ReplicationPrimary, start_replica_process, wait_for_replicas
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2023, 5, 1))
+
+    primary = ReplicationPrimary(shop, heartbeat=0.05)
+    replicas = [start_replica_process(primary) for _ in range(2)]
+    try:
+        shop.add_to_cart(bob, apple, 3)
+        shop.buy(bob, datetime.date(2023, 5, 2))
+
+        wait_for_replicas(replicas, {"Apple": 5})
+        for replica in replicas:
+            assert replica.history_descending_date(max_staleness=1) == \
+                {datetime.date(2023, 5, 2): {1: {"Apple": 3}}, datetime.date(2023, 5, 1): {1: {"Apple": 2}}}
+            assert replica.client_history(1) == {datetime.date(2023, 5, 1): {"Apple": 2},
+                                                 datetime.date(2023, 5, 2): {"Apple": 3}}
+            assert replica.history_verbal() == shop.get_history_verbal()
+    finally:
+        for replica in replicas:
+            replica.shutdown()
+        primary.close()
+
+def test__replica_staleness_follows_primary_time_of_applied_changes():
+    import threading
+    import time
+    from replication import Replica, ReplicationPrimary
+
+    now = [0.0]
+    shop = Shop()
+    apple = Product("Apple", 1)
+    shop.add_product(apple, 10)
+
+    primary = ReplicationPrimary(shop, heartbeat=0.5, clock=lambda: now[0])
+    accepting = threading.Thread(target=primary.accept)
+    accepting.start()
+    replica = Replica(primary.address, primary.authkey, clock=lambda: now[0])
+    accepting.join()
+    try:
+        # The sender is backed up while the changes are made
+        with primary._lock:
+            now[0] = 1.0
+            for _ in range(3):
+                shop.add_product(apple, 1)
+            now[0] = 10.0
+        deadline = time.monotonic() + 5
+        while replica.sequence < primary.sequence and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        # The changes arrived just now, but they are 9 seconds old
+        assert replica.inventory() == {"Apple": 13}
+        assert replica.staleness == 9.0
+        error = None
+        try:
+            replica.inventory(max_staleness=5)
+        except Exception as raised:
+            error = raised
+        assert str(error) == "Replica is too stale"
+    finally:
+        replica.close()
+        primary.close()
+
+def test__http_service_pipelined_requests_and_batched_checkout():
+    import asyncio
+    import json
+    from service import ShopService, run_load_test
+
+    async def scenario():
+        shop = Shop()
+        shop.add_product(Product("Apple", 2), 10)
+        service = ShopService(shop)
+        await service.start()
+        host, port = service.address
+
+        reader, writer = await asyncio.open_connection(host, port)
+        requests = [("POST", "/clients", {"id": 7, "membership": False, "money": 100}),
+                    ("POST", "/cart/add", {"client": 7, "product": "Apple", "amount": 3}),
+                    ("POST", "/buy", {"client": 7, "date": "2024-03-01"}),
+                    ("GET", "/inventory", None),
+                    ("GET", "/history?page=1&size=10", None),
+                    ("POST", "/cart/add", {"client": 8, "product": "Apple", "amount": 1})]
+        # Everything is sent before reading any answer
+        for method, path, data in requests:
+            body = json.dumps(data).encode() if data is not None else b""
+            writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+        answers = []
+        for _ in requests:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            answers.append((int(head.split(b" ")[1]), json.loads(await reader.readexactly(length))))
+        writer.close()
+        await service.close()
+        return answers
+
+    answers = asyncio.run(scenario())
+
+    assert [status for status, data in answers] == [201, 200, 200, 200, 200, 404]
+    assert answers[2][1] == {"money": 94}
+    assert answers[3][1] == {"Apple": 7}
+    assert answers[4][1]["items"] == [{"date": "2024-03-01", "client": 7, "items": {"Apple": 3}}]
+
+    report = asyncio.run(run_load_test(connections=5, requests=10))
+    assert report["requests"] == 5 * 11
+    assert report["requests_per_second"] > 0
+
+def test__http_service_answers_when_requests_fail():
+    import asyncio
+    import json
+    from service import ShopService
+
+    class BrokenPricing:
+        def price_batch(self, carts, date, discounts):
+            raise Exception("pricing rule is broken")
+
+    def broken_remove(client, product, amount):
+        raise RuntimeError("bug in the shop")
+
+    requests = [("/cart/add", {"client": 7, "product": "Apple", "amount": 3}),
+                ("/cart/add", {"client": 7, "product": "Apple", "amount": 100}),
+                ("/cart/add", {"client": 7, "product": "Apple"}),
+                ("/cart/remove", {"client": 7, "product": "Apple", "amount": 1}),
+                ("/buy", {"client": 7})]
+
+    async def scenario():
+        shop = Shop()
+        shop.add_product(Product("Apple", 2), 10)
+        shop.register_client(Client(7, False, 100))
+        shop.pricing = BrokenPricing()
+        shop.remove_from_cart = broken_remove
+        service = ShopService(shop)
+        await service.start()
+        reader, writer = await asyncio.open_connection(*service.address)
+        for path, data in requests:
+            body = json.dumps(data).encode()
+            writer.write(f"POST {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+        answers = []
+        for _ in requests:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            answers.append((int(head.split(b" ")[1]), json.loads(await reader.readexactly(length))))
+        writer.close()
+        await service.close()
+        return answers
+
+    answers = asyncio.run(scenario())
+    assert answers[0][0] == 200
+    # Requests the shop refuses are the client's fault, faults of the shop itself are not
+    assert answers[1] == (400, {"error": "Not enough items to add to cart"})
+    assert answers[2][0] == 400
+    assert answers[3] == (500, {"error": "Internal server error"})
+    assert answers[4] == (500, {"error": "Checkout failed: pricing rule is broken"})
+
+def test__tiered_history_spills_old_dates_to_disk():
+    import os
+    import tempfile
+    from history_store import TieredHistory, tier_history
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    banana = Product("Banana", 1)
+    bob = Client(1, False, 1000)
+    shop.register_client(bob)
+    shop.add_product(apple, 100)
+    shop.add_product(banana, 100)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = tier_history(shop, directory, hot_days=3, segment_days=2, cache_segments=1)
+        alice = Client(2, False, 1000)
+        shop.register_client(alice)
+        assert isinstance(alice.history, TieredHistory)
+
+        for day in range(1, 8):
+            shop.add_to_cart(bob, apple, 1)
+            shop.add_to_cart(alice, banana, day)
+            shop.buy(bob, datetime.date(2020, 1, day))
+            shop.buy(alice, datetime.date(2020, 1, day))
+
+        assert shop.history.hot_dates <= 3
+        assert bob.history.hot_dates <= 3
+        assert len(shop.history) == 7
+
+        # Products read back from disk are the shop's own product objects
+        assert shop.get_history_descending_date()[datetime.date(2020, 1, 1)] == {1: {apple: 1}, 2: {banana: 1}}
+        assert list(shop.get_history_descending_date())[0] == datetime.date(2020, 1, 7)
+        assert alice.get_history_verbal().startswith("On 2020-01-07, you bought: \n\t7x Banana\n")
+        assert shop.get_history_verbal().endswith("On 2020-01-01, these purchases were made:\n├id: 1\n│└1x Apple\n└id: 2\n └1x Banana\n")
+        assert cache.misses > 0
+
+        # Buying on an old date brings it back to memory
+        shop.add_to_cart(bob, apple, 2)
+        shop.buy(bob, datetime.date(2020, 1, 1))
+        assert bob.history[datetime.date(2020, 1, 1)] == {apple: 3}
+        # ... without growing memory past the budget or changing the order of the dates
+        assert shop.history.hot_dates <= 3 and bob.history.hot_dates <= 3
+        assert list(shop.get_history_descending_date()) == [datetime.date(2020, 1, day) for day in range(7, 0, -1)]
+        assert shop.get_history_descending_date()[datetime.date(2020, 1, 1)] == {1: {apple: 3}, 2: {banana: 1}}
+        # Segments whose dates were all rewritten are deleted
+        live = {path for history in (shop.history, bob.history, alice.history) for path in history._cold.values()}
+        segments = shop.history.directory
+        assert set(os.path.join(segments, name) for name in os.listdir(segments)) == live
+
+        # Segments of a deleted client go with the client
+        shop.delete_client(alice)
+        live = {path for history in (shop.history, bob.history) for path in history._cold.values()}
+        assert set(os.path.join(segments, name) for name in os.listdir(segments)) == live
+
+        # Another shop tiered into the same directory doesn't overwrite the segments of the first
+        other = Shop()
+        plum = Product("Plum", 1)
+        other.add_product(plum, 1)
+        for day in range(1, 8):
+            other.history[datetime.date(2020, 1, day)] = {1: {plum: day}}
+        tier_history(other, directory, hot_days=3, segment_days=2)
+        assert shop.get_history_descending_date()[datetime.date(2020, 1, 2)] == {1: {apple: 1}, 2: {banana: 2}}
+
+def test__tiered_history_entry_budget_holds_for_purchases_on_the_same_day():
+    import tempfile
+    from history_store import tier_history
+
+    shop = Shop()
+    products = [Product(f"P{number}", 1) for number in range(6)]
+    bob = Client(1, False, 1000)
+    shop.register_client(bob)
+    for product in products:
+        shop.add_product(product, 10)
+
+    with tempfile.TemporaryDirectory() as directory:
+        tier_history(shop, directory, hot_days=30, hot_entries=3, segment_days=1)
+        for day, product in enumerate(products, 1):
+            shop.add_to_cart(bob, product, 1)
+            shop.buy(bob, datetime.date(2020, 1, 1 + day // 3))
+            assert sum(len(purchases[1]) for purchases in shop.history._hot.values()) <= 3 or shop.history.hot_dates == 1
+        assert shop.history.hot_dates == 1
+        assert len(shop.history) == 3 and shop.history[datetime.date(2020, 1, 1)] == {1: {products[0]: 1, products[1]: 1}}
+
+def test__recommendations_from_purchases_and_backfill():
+    from recommendations import CoOccurrenceIndex
+
+    shop = Shop()
+    bread = Product("Bread", 1)
+    butter = Product("Butter", 2)
+    jam = Product("Jam", 3)
+    milk = Product("Milk", 1)
+    for product in (bread, butter, jam, milk):
+        shop.add_product(product, 100)
+
+    bob = Client(1, False, 1000)
+    alice = Client(2, False, 1000)
+    shop.register_client(bob)
+    shop.register_client(alice)
+
+    def purchase(client, date, products):
+        for product in products:
+            shop.add_to_cart(client, product, 1)
+        shop.buy(client, date)
+
+    purchase(bob, datetime.date(2021, 1, 1), [bread, butter, jam])
+    purchase(alice, datetime.date(2021, 1, 1), [bread, butter])
+    purchase(alice, datetime.date(2021, 1, 2), [bread, milk])
+
+    backfilled = CoOccurrenceIndex()
+    backfilled.backfill(shop, workers=2, chunk_dates=1)
+    assert backfilled.recommend(bread, 3) == [butter, jam, milk]
+
+    live = CoOccurrenceIndex(neighbours=1)
+    live.attach(shop)
+    purchase(bob, datetime.date(2021, 1, 3), [jam, bread])
+    purchase(bob, datetime.date(2021, 1, 4), [jam, butter])
+    purchase(bob, datetime.date(2021, 1, 5), [jam, milk])
+    purchase(bob, datetime.date(2021, 1, 6), [jam, milk])
+    purchase(bob, datetime.date(2021, 1, 7), [jam, milk])
+
+    assert live.recommend(jam, 1) == [milk]
+    # Only twice the neighbour bound is kept per product
+    assert len(live.counts[jam]) <= 2
+    assert live.recommend(Product("Unknown", 1)) == []
+
+def test__purchase_index_buyers_by_product_and_date():
+    from purchase_index import PurchaseIndex
+
+    shop = Shop()
+    tea = Product("Tea", 3)
+    cup = Product("Cup", 5)
+    shop.add_product(tea, 100)
+    shop.add_product(cup, 100)
+
+    bob = Client(1, False, 1000)
+    alice = Client(2, False, 1000)
+    shop.register_client(bob)
+    shop.register_client(alice)
+
+    shop.add_to_cart(bob, tea, 2)
+    shop.buy(bob, datetime.date(2022, 6, 1))
+
+    index = PurchaseIndex()
+    index.attach(shop)
+
+    shop.add_to_cart(alice, tea, 1)
+    shop.add_to_cart(alice, cup, 4)
+    shop.buy(alice, datetime.date(2022, 6, 3))
+    shop.add_to_cart(bob, cup, 1)
+    # Late arriving order is sorted into place
+    shop.buy(bob, datetime.date(2022, 5, 20))
+
+    assert index.buyers(tea) == [(1, datetime.date(2022, 6, 1), 2), (2, datetime.date(2022, 6, 3), 1)]
+    assert index.buyers(tea, start=datetime.date(2022, 6, 2)) == [(2, datetime.date(2022, 6, 3), 1)]
+    assert index.buyers(cup, end=datetime.date(2022, 6, 1)) == [(1, datetime.date(2022, 5, 20), 1)]
+    assert index.buyers_of_any([tea, cup]) == [(1, datetime.date(2022, 5, 20), cup, 1),
+                                               (1, datetime.date(2022, 6, 1), tea, 2),
+                                               (2, datetime.date(2022, 6, 3), tea, 1),
+                                               (2, datetime.date(2022, 6, 3), cup, 4)]
+    assert index.buyers_of_all([tea, cup]) == [1, 2]
+    assert index.buyers_of_all([tea, cup], start=datetime.date(2022, 6, 2)) == [2]
+    assert index.buyers_of_all([tea, Product("Saucer", 1)]) == []
+
+    index.detach(shop)
+    shop.add_to_cart(bob, tea, 1)
+    shop.buy(bob, datetime.date(2022, 6, 4))
+    assert len(index.buyers(tea)) == 2
+
+def test__ingest_orders_from_json_lines():
+    import json
+    import os
+    import tempfile
+    from ingest import ingest_orders
+
+    def make_shop():
+        shop = Shop()
+        shop.add_product(Product("Apple", 1), 100)
+        shop.add_product(Product("Pear", 2), 5)
+        shop.register_client(Client(1, False, 1000))
+        shop.register_client(Client(2, False, 3))
+        return shop
+
+    rows = [json.dumps({"client": 1, "date": "2024-01-01", "items": {"Apple": 2, "Pear": 1}}),
+            "not json",
+            json.dumps({"client": 3, "date": "2024-01-01", "items": {"Apple": 1}}),
+            json.dumps({"client": 2, "date": "2024-01-01", "items": {"Pear": 2}}),
+            json.dumps({"client": 1, "date": "2024-01-02", "items": {"Apple": 3}}),
+            json.dumps({"client": 1, "date": "2024-01-02", "items": {"Mango": 3}}),
+            json.dumps({"client": 1, "date": "2024-01-03", "items": {"Pear": 10}}),
+            json.dumps({"client": 1, "items": {"Apple": 1}})]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "orders.jsonl")
+        with open(path, "w") as file:
+            file.write("\n".join(rows) + "\n")
+
+        for workers in (None, 2):
+            shop = make_shop()
+            report = ingest_orders(shop, path, chunk_size=3, workers=workers, max_pending=1)
+            apple, pear = list(shop.inventory)
+            bob = shop.get_client(1)
+
+            assert report.orders == 8 and report.applied == 2
+            assert [line for line, message in report.errors] == [2, 3, 4, 6, 7, 8]
+            assert dict(report.errors)[4] == "Client has insufficient funds"
+            assert bob.history == {datetime.date(2024, 1, 1): {apple: 2, pear: 1}, datetime.date(2024, 1, 2): {apple: 3}}
+            # Stock of the failed orders is back in the inventory
+            assert shop.inventory == {apple: 95, pear: 4}
+            assert shop.get_client(2).shopping_cart.items == {}
+
+def test__ingest_orders_survives_failing_checkout():
+    import json
+    import os
+    import tempfile
+    from ingest import ingest_orders
+
+    class BrokenPricing:
+        def price_batch(self, carts, date, discounts):
+            raise Exception("pricing rule is broken")
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    shop.add_product(apple, 10)
+    shop.register_client(Client(1, False, 100))
+    shop.register_client(Client(2, False, 100))
+    shop.pricing = BrokenPricing()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "orders.jsonl")
+        with open(path, "w") as file:
+            for client_id in (1, 2):
+                file.write(json.dumps({"client": client_id, "date": "2024-01-01", "items": {"Apple": 1}}) + "\n")
+        report = ingest_orders(shop, path)
+
+    assert report.applied == 0
+    assert report.errors == [(1, "Checkout failed: pricing rule is broken"), (2, "Checkout failed: pricing rule is broken")]
+    assert shop.reserved == {apple: 0} and shop.available(apple) == 10
+    assert shop.get_client(1).shopping_cart.items == {} and shop.get_client(2).shopping_cart.items == {}
+
+def test__event_log_point_in_time_views():
+    from timeline import EventLog
+
+    now = [datetime.datetime(2023, 4, 1, 9, 0)]
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 1000)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+
+    log = EventLog(checkpoint_every=2, clock=lambda: now[0])
+    log.attach(shop)
+
+    for hour in range(10, 16):
+        now[0] = datetime.datetime(2023, 4, 1, hour, 0)
+        shop.add_to_cart(bob, apple, 1)
+    shop.buy(bob, datetime.date(2023, 4, 1))
+
+    now[0] = datetime.datetime(2023, 4, 2, 12, 0)
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2023, 4, 2))
+
+    assert log.as_of(datetime.datetime(2023, 4, 1, 9, 30)).inventory == {apple: 10}
+    assert log.as_of(datetime.datetime(2023, 4, 1, 14, 0)).inventory == {apple: 5}
+    assert log.as_of(datetime.date(2023, 4, 1)).inventory == {apple: 4}
+    assert log.as_of(datetime.date(2023, 4, 2)).inventory == {apple: 2}
+
+    assert log.as_of(datetime.datetime(2023, 4, 1, 14, 0)).client_history(1) == {}
+    assert log.as_of(datetime.date(2023, 4, 1)).client_history(1) == {datetime.date(2023, 4, 1): {apple: 6}}
+    assert log.client_history_as_of(1, datetime.date(2023, 4, 2)) == {datetime.date(2023, 4, 1): {apple: 6},
+                                                                       datetime.date(2023, 4, 2): {apple: 2}}
+
+    # Before attach nothing was recorded
+    error = None
+    try:
+        log.as_of(datetime.datetime(2000, 1, 1))
+    except Exception as raised:
+        error = raised
+    assert str(error) == "No recorded state that old"
+    assert log.as_of(datetime.datetime(2023, 4, 1, 9, 0)).inventory == {apple: 10}
+
+def test__day_bucket_history_keeps_date_interface():
+    from history_store import DayBucketHistory, bucket_history
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 1000)
+    shop.register_client(bob)
+    shop.add_product(apple, 100)
+    shop.add_to_cart(bob, apple, 1)
+    shop.buy(bob, datetime.date(2020, 1, 5))
+
+    bucket_history(shop)
+    alice = Client(2, False, 1000)
+    shop.register_client(alice)
+    assert isinstance(alice.history, DayBucketHistory)
+
+    for day in (7, 2, 7):
+        shop.add_to_cart(alice, apple, day)
+        shop.buy(alice, datetime.date(2020, 1, day))
+
+    assert alice.history == {datetime.date(2020, 1, 2): {apple: 2}, datetime.date(2020, 1, 7): {apple: 14}}
+    assert list(shop.get_history_descending_date()) == [datetime.date(2020, 1, 7), datetime.date(2020, 1, 5),
+                                                        datetime.date(2020, 1, 2)]
+    assert shop.history.between(datetime.date(2020, 1, 3), datetime.date(2020, 1, 31)) == \
+        [(datetime.date(2020, 1, 5), {1: {apple: 1}}), (datetime.date(2020, 1, 7), {2: {apple: 14}})]
+    assert alice.get_history_verbal().startswith("On 2020-01-07, you bought: \n\t14x Apple\n")
+    assert datetime.date(2020, 1, 3) not in shop.history and len(shop.history) == 3
+
+    del shop.history[datetime.date(2020, 1, 5)]
+    assert list(shop.history) == [datetime.date(2020, 1, 2), datetime.date(2020, 1, 7)]
+
+def test__history_verbal_parallel_matches_serial():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    pear = Product("Pear", 1)
+    shop.add_product(apple, 1000)
+    shop.add_product(pear, 1000)
+    clients = [Client(number, False, 1000) for number in range(3)]
+    for client in clients:
+        shop.register_client(client)
+
+    for day in range(1, 11):
+        for client in clients[:day % 3 + 1]:
+            shop.add_to_cart(client, apple, day)
+            if client.id != 1:
+                shop.add_to_cart(client, pear, 1)
+            shop.buy(client, datetime.date(2019, 3, day))
+
+    serial = shop.get_history_verbal()
+    assert serial.startswith("On 2019-03-10, these purchases were made:\n├id: 0\n│├10x Apple\n│└1x Pear\n└id: 1\n └10x Apple\n")
+    assert shop.get_history_verbal(workers=2, chunk_dates=3) == serial
+
+def test__reservation_aware_inventory():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    pear = Product("Pear", 1)
+    bob = Client(1, False, 1000)
+    alice = Client(2, False, 1000)
+    shop.register_client(bob)
+    shop.register_client(alice)
+    shop.add_product(apple, 20)
+    shop.add_product(pear, 10)
+
+    shop.add_to_cart(bob, apple, 5)
+    shop.add_to_cart(bob, pear, 2)
+    shop.add_to_cart(alice, apple, 3)
+    shop.remove_from_cart(alice, apple, 1)
+
+    assert (shop.available(apple), shop.reserved_stock(apple), shop.on_hand(apple)) == (13, 7, 20)
+
+    shop.buy(alice, datetime.date(2020, 5, 5))
+    assert (shop.available(apple), shop.reserved_stock(apple), shop.on_hand(apple)) == (13, 5, 18)
+
+    changes = []
+    shop.add_observer(inventory=lambda product, delta, level: changes.append((product, delta, level)))
+    shop.delete_client(bob)
+
+    assert changes == [(apple, 5, 18), (pear, 2, 10)]
+    assert shop.inventory == {apple: 18, pear: 10}
+    assert shop.reserved == {apple: 0, pear: 0}
+    assert bob.shopping_cart.items == {}
+
+def test__client_analytics_columnar_metrics():
+    from analytics import client_metrics, compute_metrics, export_history
+
+    shop = Shop()
+    apple = Product("Apple", 2)
+    shop.add_product(apple, 1000)
+    clients = [Client(number, number % 2 == 1, 1000) for number in range(5)]
+    for client in clients:
+        shop.register_client(client)
+
+    for day in (1, 10, 30):
+        for client in clients[1:]:
+            shop.add_to_cart(client, apple, client.id)
+            shop.buy(client, datetime.date(2021, 1, day))
+
+    export = export_history(shop)
+    table = client_metrics(export, workers=2, partitions=3)
+
+    assert list(table["client_id"]) == [0, 1, 2, 3, 4]
+    assert list(table["purchases"]) == [0, 3, 3, 3, 3]
+    assert [round(value, 2) for value in table["lifetime_spend"]] == [0, 5.4, 12, 16.2, 24]
+    assert list(table["basket_size"]) == [0, 1, 2, 3, 4]
+    assert list(table["purchase_frequency"]) == [0, 3, 3, 3, 3]
+    assert compute_metrics(export) == table
+
+    # Spend is what was paid, changing the price afterwards doesn't change it
+    apple.price = 100
+    assert list(export_history(shop).spend) == list(export.spend)
+
+def test__tracing_exports_chrome_trace_events():
+    import json
+    import os
+    import tempfile
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+
+    tracer = shop.enable_tracing(Tracer(capacity=6))
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2020, 2, 2))
+
+    # Ring buffer keeps the last six spans, inner spans close before the method that contains them
+    assert [span[0] for span in tracer.spans] == ["registration check", "funds check", "history merge",
+                                                  "cart empty", "_complete_purchase", "buy"]
+    assert [span[3] for span in tracer.spans] == [1, 1, 2, 2, 1, 0]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.json")
+        tracer.export(path)
+        with open(path) as file:
+            events = json.load(file)["traceEvents"]
+    assert len(events) == 6
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    buy = events[-1]
+    assert all(buy["ts"] <= event["ts"] and event["ts"] + event["dur"] <= buy["ts"] + buy["dur"] for event in events)
+
+    shop.disable_tracing()
+    assert "buy" not in vars(shop)
+    shop.add_to_cart(bob, apple, 1)
+    assert len(tracer.spans) == 6
+
+    unsampled = shop.enable_tracing(Tracer(sample_rate=0))
+    shop.buy(bob, datetime.date(2020, 2, 3))
+    assert len(unsampled.spans) == 0
+
+def test__tracing_recovers_from_errors_inside_spans():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+    shop.add_to_cart(bob, apple, 2)
+
+    class BrokenPricing:
+        def price(self, cart, date, discount):
+            raise Exception("pricing rule is broken")
+
+    tracer = shop.enable_tracing()
+    shop.pricing = BrokenPricing()
+    try:
+        shop.buy(bob, datetime.date(2020, 1, 1))
+    except Exception:
+        pass
+    assert tracer._open == []
+    assert [(span[0], span[3]) for span in tracer.spans] == [("registration check", 1), ("funds check", 1), ("buy", 0)]
+
+    shop.pricing = None
+    shop.add_product(apple, 1)
+    assert tracer.spans[-1][0] == "add_product" and tracer.spans[-1][3] == 0
+
+def test__fork_is_isolated_copy_on_write():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    bob = Client(1, False, 100)
+    alice = Client(2, False, 100)
+    shop.register_client(bob)
+    shop.register_client(alice)
+    shop.add_product(apple, 10)
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2020, 1, 1))
+
+    fork = shop.fork()
+    # The parent's client objects are accepted, the fork copies them on first touch
+    fork.add_to_cart(bob, apple, 3)
+    fork.buy(bob, datetime.date(2020, 1, 1))
+    fork.register_client(Client(3, False, 5))
+    shop.add_to_cart(alice, apple, 1)
+
+    assert bob.money == 98 and bob.history == {datetime.date(2020, 1, 1): {apple: 2}}
+    assert fork.get_client(1).money == 95 and fork.get_client(1) is not bob
+    assert shop.history == {datetime.date(2020, 1, 1): {1: {apple: 2}}}
+    assert fork.history == {datetime.date(2020, 1, 1): {1: {apple: 5}}}
+    assert shop.inventory[apple] == 7 and fork.inventory[apple] == 5
+    assert shop.get_client(3) is None and len(fork.clients) == 3
+
+    # The parent changing a client it still shares doesn't reach a fork of the fork either
+    nested = fork.fork()
+    shop.buy(alice, datetime.date(2020, 1, 2))
+    assert nested.get_client(2).money == 100 and nested.get_client(2).history == {}
+    assert datetime.date(2020, 1, 2) not in nested.history
+    assert fork.get_client(2).shopping_cart.items == {} and alice.money == 99
+    nested.add_to_cart(nested.get_client(1), apple, 1)
+    assert fork.get_client(1).shopping_cart.items == {}
+
+    forks = [shop.fork() for _ in range(30)]
+    forks[0].add_product(apple, 100)
+    assert shop.inventory[apple] == 7 and forks[1].inventory[apple] == 7 and forks[0].inventory[apple] == 107
+
+def test__fork_keeps_date_order_after_new_dates():
+    shop = Shop()
+    apple = Product("Apple", 1)
+    pear = Product("Pear", 1)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_product(apple, 10)
+    shop.add_to_cart(bob, apple, 1)
+    shop.buy(bob, datetime.date(2024, 1, 1))
+
+    fork = shop.fork()
+    fork.add_to_cart(bob, apple, 1)
+    fork.buy(bob, datetime.date(2024, 1, 2))
+    fork.add_product(pear, 5)
+
+    assert list(fork.history) == [datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)]
+    assert list(fork.get_history_descending_date()) == [datetime.date(2024, 1, 2), datetime.date(2024, 1, 1)]
+    assert fork.get_history_verbal().index("2024-01-02") < fork.get_history_verbal().index("2024-01-01")
+    assert list(fork.inventory) == [apple, pear]
+
+def test__memory_report_counts_shared_objects_once():
+    import tracemalloc
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    shop.add_product(apple, 100)
+    bob = Client(1, False, 100)
+    shop.register_client(bob)
+    shop.add_to_cart(bob, apple, 2)
+    shop.buy(bob, datetime.date(2020, 1, 1))
+    shop.add_to_cart(bob, apple, 1)
+
+    report = shop.memory_report()
+    assert list(report.sections) == ["products", "inventory", "history", "client_history", "carts", "clients"]
+    assert report.sections["products"] == (deep_size(apple), 1)
+    assert report.sections["history"][1] == 1 and report.average("carts") > 0
+    # Everything reachable from the parts is counted exactly once
+    seen = set()
+    assert report.total == sum(deep_size(obj, seen) for obj in [apple, shop.inventory, shop.reserved, shop.history,
+                                                               bob.history, bob.shopping_cart, shop.clients, shop._clients_by_id])
+    assert report.snapshot is None
+
+    tracemalloc.start()
+    try:
+        before = shop.memory_report()
+        clients = [Client(id, False, 10) for id in range(2, 500)]
+        after = shop.memory_report(since=before, top=3)
+    finally:
+        tracemalloc.stop()
+    assert len(after.allocations) == 3 and after.allocations[0].size_diff > 0
+
+def test__idle_clients_are_evicted_and_paged_back():
+    import gc
+    import os
+    import tempfile
+    from history_store import page_clients
+
+    shop = Shop()
+    apple = Product("Apple", 1)
+    shop.add_product(apple, 100)
+    for id in range(1, 6):
+        shop.register_client(Client(id, False, 50))
+    shop.add_to_cart(shop.get_client(1), apple, 10)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = page_clients(shop, os.path.join(directory, "sessions"), capacity=2)
+        assert len(shop.clients) == 2 and len(store) == 3 and 1 in store
+        # The evicted cart still holds its stock
+        assert shop.available(apple) == 90 and shop.reserved_stock(apple) == 10
+        gc.collect()
+
+        bob = shop.get_client(1)
+        assert bob.shopping_cart.items == {apple: 10} and bob.shopping_cart.items.popitem()[0] is apple
+        bob.shopping_cart.add(apple, 10)
+        shop.buy(bob, datetime.date(2020, 1, 1))
+        assert bob.money == 40 and shop.reserved_stock(apple) == 0 and 1 not in store
+
+        # A client the program still holds comes back as the same object
+        alice = shop.get_client(2)
+        shop.get_client(3)
+        shop.get_client(4)
+        assert 2 in store
+        shop.add_to_cart(alice, apple, 5)
+        assert shop.get_client(2) is alice and alice.shopping_cart.items == {apple: 5}
+
+        shop.register_client(Client(1, False, 0))
+        assert shop.get_client(1).money == 40
+        assert shop.buy_many([(shop.get_client(id), datetime.date(2020, 1, 2)) for id in range(1, 6)]) == [True] * 5
+        assert alice.money == 45 and store.evictions > 0
+
+        # Reports and history moves see every client, not only the ones in memory
+        from analytics import export_history
+        from history_store import bucket_history
+        assert sorted(export_history(shop).client_ids) == [1, 2, 3, 4, 5] and len(shop.clients) == 2
+        error = None
+        try:
+            bucket_history(shop)
+        except Exception as raised:
+            error = raised
+        assert str(error) == "History can't be moved while clients are evicted"
+
+        store.close()
+    assert len(shop.clients) == 5 and shop.sessions is None and shop.available(apple) == 85
@@ -0,0 +1,143 @@
+import bisect
+import datetime
+
+from epood import Product, Shop
+
+class ShopView:
+    def __init__(self, log, timestamp: datetime.datetime, inventory: dict) -> None:
+        """
+        Initialize a read-only view of the shop at a point in time.
+
+        :param log: The EventLog the view was made from.
+        :param timestamp: The point in time of the view.
+        :param inventory: The inventory at that time as {product: amount, ...}.
+        """
+        self.log = log
+        self.timestamp = timestamp
+        self.inventory = inventory
+
+    def client_history(self, client_id: int) -> dict:
+        """
+        What the client had bought by the time of the view.
+
+        :param client_id: Id of the client.
+        :return: History as {date: {product: amount, ...}, ...}.
+        """
+        return self.log.client_history_as_of(client_id, self.timestamp)
+
+class EventLog:
+    def __init__(self, checkpoint_every: int = 1000, clock=datetime.datetime.now) -> None:
+        """
+        Initialize a versioned log of inventory changes and purchases.
+
+        Every checkpoint_every inventory changes a copy of the inventory is kept, so a
+        past inventory is rebuilt from the nearest checkpoint with at most that many
+        changes replayed on top of it.
+
+        :param checkpoint_every: How many inventory changes there are between checkpoints.
+        :param clock: Function returning the current time as a datetime.
+        """
+        self.checkpoint_every = checkpoint_every
+        self.clock = clock
+        self.version = 0
+        # When recording started, nothing is known about the shop before it
+        self.started = clock()
+        self._current = {}
+        # Inventory changes as parallel lists, times are kept apart for bisecting
+        self._times = []
+        self._changes = []
+        # Checkpoints as parallel lists of the amount of changes before them and the inventory copies
+        self._checkpoint_positions = [0]
+        self._checkpoints = [{}]
+        # {client id: ([time, ...], [(date, items), ...])}
+        self._purchases = {}
+
+    def attach(self, shop: Shop) -> None:
+        """
+        Start recording the changes of the shop, the current inventory is the first checkpoint.
+
+        :param shop: The shop whose changes are recorded.
+        """
+        self.started = self.clock()
+        self._current = dict(shop.inventory)
+        self._checkpoint_positions = [len(self._changes)]
+        self._checkpoints = [dict(self._current)]
+        shop.add_observer(inventory=self.record_inventory, purchase=self.record_purchase)
+
+    def detach(self, shop: Shop) -> None:
+        """
+        Stop recording the changes of the shop, what is recorded so far can still be queried.
+
+        :param shop: The shop the log was attached to.
+        """
+        shop.remove_observer(inventory=self.record_inventory, purchase=self.record_purchase)
+
+    def record_inventory(self, product: Product, delta: int, level: int) -> None:
+        """
+        Record an inventory change. Has the signature of a Shop inventory observer.
+
+        :param product: Product whose stock changed.
+        :param delta: Change of the stock.
+        :param level: Stock level after the change.
+        """
+        self.version += 1
+        self._times.append(self.clock())
+        self._changes.append((product, level))
+        self._current[product] = level
+        if len(self._changes) - self._checkpoint_positions[-1] >= self.checkpoint_every:
+            self._checkpoint_positions.append(len(self._changes))
+            self._checkpoints.append(dict(self._current))
+
+    def record_purchase(self, client_id: int, date: datetime.date, items: dict) -> None:
+        """
+        Record a purchase. Has the signature of a Shop purchase observer.
+
+        :param client_id: Id of the client that made the purchase.
+        :param date: Date of the purchase.
+        :param items: The bought products as {product: amount, ...}.
+        """
+        self.version += 1
+        times, purchases = self._purchases.setdefault(client_id, ([], []))
+        times.append(self.clock())
+        purchases.append((date, dict(items)))
+
+    def as_of(self, timestamp) -> ShopView:
+        """
+        Rebuild the state of the shop at a point in time.
+
+        :param timestamp: A datetime, or a date meaning the end of that day.
+        :return: Read-only view of the inventory and the purchases at that time.
+        """
+        if not isinstance(timestamp, datetime.datetime):
+            timestamp = datetime.datetime.combine(timestamp, datetime.time.max)
+
+        if timestamp < self.started:
+            raise Exception("No recorded state that old")
+
+        end = bisect.bisect_right(self._times, timestamp)
+        checkpoint = bisect.bisect_right(self._checkpoint_positions, end) - 1
+
+        inventory = dict(self._checkpoints[checkpoint])
+        for product, level in self._changes[self._checkpoint_positions[checkpoint]:end]:
+            inventory[product] = level
+
+        return ShopView(self, timestamp, inventory)
+
+    def client_history_as_of(self, client_id: int, timestamp) -> dict:
+        """
+        What a client had bought at a point in time, without rebuilding the inventory.
+
+        :param client_id: Id of the client.
+        :param timestamp: A datetime, or a date meaning the end of that day.
+        :return: History as {date: {product: amount, ...}, ...}.
+        """
+        if not isinstance(timestamp, datetime.datetime):
+            timestamp = datetime.datetime.combine(timestamp, datetime.time.max)
+        times, purchases = self._purchases.get(client_id, ([], []))
+        history = {}
+        # Only this client's purchases are looked at, the time doesn't grow with the whole shop
+        for date, items in purchases[:bisect.bisect_right(times, timestamp)]:
+            day = history.setdefault(date, {})
+            for product, amount in items.items():
+                day[product] = day.get(product, 0) + amount
+        return history